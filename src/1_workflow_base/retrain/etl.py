@@ -15,6 +15,9 @@ Author: Ivan Nardini (ivan.nardini@sas.com)
 
 import os
 import yaml
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import sqlalchemy
 from sqlalchemy import create_engine
 import pandas as pd
@@ -24,6 +27,9 @@ logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p',
                     level=logging.INFO)
 
+# Chunks read ahead for each table being extracted
+PREFETCH_CHUNKS = 2
+
 
 # Helpers --------------------------------------------------------------------------------------------------------------
 def load_yaml (configpath: str) -> dict:
@@ -38,7 +44,7 @@ def load_yaml (configpath: str) -> dict:
 
 
 def create_connection (driver: str, username: str, password: str, hostname: str, port: int,
-                       dbname: str) -> sqlalchemy.engine:
+                       dbname: str, pool_size: int = None) -> sqlalchemy.engine:
     '''
     Create engine based on connection string
     :param driver:
@@ -47,19 +53,33 @@ def create_connection (driver: str, username: str, password: str, hostname: str,
     :param hostname:
     :param port:
     :param dbname:
+    :param pool_size: connections kept in the pool, with no overflow. If None, the sqlalchemy default
     :return: engine
     '''
+    if driver == 'sqlite':
+        # Embedded database for local runs: dbname is the database file
+        return create_engine(f'sqlite:///{dbname}')
     conn_str = f'{driver}://{username}:{password}@{hostname}:{port}/{dbname}'
-    engine = create_engine(conn_str)
+    pool_args = {} if pool_size is None else {'pool_size': pool_size, 'max_overflow': 0}
+    engine = create_engine(conn_str, **pool_args)
     return engine
 
 
-def write_get_table_names_query (tableprefix: str) -> str:
+def write_get_table_names_query (tableprefix: str, dialect: str = 'postgresql') -> str:
     '''
     Write query for getting table names
     :param tableprefix:
+    :param dialect: database dialect name
     :return: query
     '''
+    if dialect == 'sqlite':
+        # No information_schema in sqlite: same columns from its catalog
+        query = """
+        SELECT 'main' AS table_schema, name AS table_name
+        FROM sqlite_master
+        WHERE type = 'table' AND name like '{}%';
+        """.format(tableprefix)
+        return query
     query = """
     SELECT table_schema, table_name
     FROM information_schema.tables
@@ -68,41 +88,137 @@ def write_get_table_names_query (tableprefix: str) -> str:
     return query
 
 
+def get_table_sequence (tablename: str) -> int:
+    '''
+    Get the sequence number of a performance table, named {prefix}_{sequence}_{timelabel}{sequence}
+    :param tablename:
+    :return: sequence, None if the table is not named as a performance table
+    '''
+    parts = tablename.rsplit('_', 2)
+    if len(parts) == 3 and parts[1].isdigit():
+        return int(parts[1])
+    return None
+
+
 def get_table_metas_list (connection: sqlalchemy.engine, query: str) -> list:
     '''
-    Get list of table names
+    Get list of table names, in table sequence order
     :param connection:
     :param query:
     :return: tbl_names
     '''
     tbl_metas = pd.read_sql(query, connection).values.tolist()
+    # Tables not named as performance tables go last
+    tbl_metas.sort(key=lambda tbl_meta: (get_table_sequence(tbl_meta[1]) is None,
+                                         get_table_sequence(tbl_meta[1]) or 0, tbl_meta[1]))
     return tbl_metas
 
 
-def write_select_tables_query (tablenames: list) -> str:
+def quote_identifier (name: str) -> str:
+    '''
+    Quote a column name, so case and special characters are kept
+    :param name:
+    :return: quoted_name
+    '''
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def write_select_tables_query (tablenames: list, columns: list = None) -> str:
     '''
     Write select queries
     :param tablenames:
+    :param columns: columns to select. If None, all the columns
     :return: queries
     '''
+    select_list = ', '.join(quote_identifier(column) for column in columns) if columns else '*'
     queries = []
     for tableschema, tablename in tablenames:
         query = """
-        SELECT *
+        SELECT {}
         FROM {}."{}";
-        """.format(tableschema, tablename)
+        """.format(select_list, tableschema, tablename)
         queries.append(query)
     return queries
 
-def extract_tables (connection, queries):
+
+def read_table_chunks (connection, query: str, chunksize: int = None):
     '''
-    Extraxt tables from Postgres
+    Read a table in chunks over a server-side cursor: the db sends chunksize rows at a time
+    and only the chunk being read is in memory
+    :param connection:
+    :param query:
+    :param chunksize: rows for each chunk. If None, the table in one chunk
+    :return: dfs generator
+    '''
+    with connection.connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        if not chunksize:
+            yield pd.read_sql_query(query, conn)
+        else:
+            yield from pd.read_sql_query(query, conn, chunksize=chunksize)
+
+
+def prefetch_table_chunks (connection, query: str, chunksize: int, chunks: queue.Queue, stop: threading.Event):
+    '''
+    Read the chunks of a table in a worker, putting them in a bounded queue.
+    The queue ends with None, or with the error of the query. The worker gives up when stop is set
+    :param connection:
+    :param query:
+    :param chunksize:
+    :param chunks: queue of PREFETCH_CHUNKS chunks at most
+    :param stop:
+    :return: None
+    '''
+    def put (item) -> bool:
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        for df in read_table_chunks(connection, query, chunksize):
+            if not put(df):
+                return
+    except Exception as error:
+        put(error)
+        return
+    put(None)
+
+
+def extract_tables (connection, queries, max_queries: int = 1, chunksize: int = None):
+    '''
+    Extraxt tables from Postgres, max_queries at a time.
+    Each query runs on its own connection of the engine pool. Tables are read ahead by the workers,
+    up to PREFETCH_CHUNKS chunks each, while the chunks are consumed in the order of the queries
     :param connection:
     :param queries:
-    :return: dfs
+    :param max_queries: maximum number of parallel queries
+    :param chunksize: rows for each chunk. If None, one chunk for each table
+    :return: dfs generator, the chunks in the same order of the queries
     '''
-    dfs = [pd.read_sql_query(query, connection) for query in queries]
-    return dfs
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=PREFETCH_CHUNKS) for _ in queries]
+    with ThreadPoolExecutor(max_workers=max_queries) as executor:
+        # Tables start in the order of the queries, so the table being consumed is always read
+        futures = [executor.submit(prefetch_table_chunks, connection, query, chunksize, chunks, stop)
+                   for query, chunks in zip(queries, queues)]
+        try:
+            for chunks in queues:
+                df = chunks.get()
+                while df is not None:
+                    if isinstance(df, Exception):
+                        raise df
+                    yield df
+                    df = chunks.get()
+        finally:
+            # Consumer done or gone: release the workers
+            stop.set()
+            for future in futures:
+                future.cancel()
+
 
 def select_columns (dataframe: pd.DataFrame, labels: list) -> pd.DataFrame:
     '''
@@ -113,14 +229,16 @@ def select_columns (dataframe: pd.DataFrame, labels: list) -> pd.DataFrame:
     df = dataframe[labels]
     return df
 
-def create_training_dataframe (raw_dfs: list, labels: list) -> pd.DataFrame:
+def create_training_dataframe (raw_dfs, labels: list) -> pd.DataFrame:
     '''
-    Append dataframes one to another
-    :param datapaths:
+    Append dataframes (the table chunks) one to another.
+    Each chunk is projected as it comes from the raw_dfs iterable
+    :param raw_dfs: dataframes iterable
     :return: train_df
     '''
     dfs = [select_columns(df, labels) for df in raw_dfs]
-    train_df = pd.concat(dfs)
+    # A chunk with only NULLs in a numeric column reads it as object: restore the column type
+    train_df = pd.concat(dfs, ignore_index=True).infer_objects()
     return train_df
 
 def write_traindf (train_df: pd.DataFrame, datapath: str):
@@ -144,15 +262,25 @@ def build_extract (config):
     hostname = config['db_endpoint_meta']['hostname']
     port = config['db_endpoint_meta']['port']
     dbname = config['db_endpoint_meta']['dbname']
+    max_queries = config['db_endpoint_meta'].get('max_queries', 1)
+    chunksize = config['db_endpoint_meta'].get('chunksize')
     tableprefix = config['table_meta']['prefix']
+    labels = config['variables_schema_meta']['labels']
 
     def extract ():
-        conn = create_connection(driver, username, password, hostname, port, dbname)
-        query = write_get_table_names_query(tableprefix)
-        table_metas = get_table_metas_list(conn, query)
-        queries = write_select_tables_query(table_metas)
-        dfs = extract_tables(conn, queries)
-        return dfs
+        '''
+        Stream the chunks of the performance tables, in table sequence order
+        :return: dfs generator
+        '''
+        conn = create_connection(driver, username, password, hostname, port, dbname, pool_size=max_queries)
+        try:
+            query = write_get_table_names_query(tableprefix, conn.dialect.name)
+            table_metas = get_table_metas_list(conn, query)
+            # Only the retraining columns are read
+            queries = write_select_tables_query(table_metas, labels)
+            yield from extract_tables(conn, queries, max_queries, chunksize)
+        finally:
+            conn.dispose()
 
     return extract
 
@@ -188,9 +316,9 @@ def main ():
     load = build_load(CONFIG)
 
     # Run the process --------------------------------------------
-    logging.info('Extract performance data from Viya Postgresql...')
+    # Chunks are extracted from Postgresql as the transform consumes them
+    logging.info('Extract and transform performance data from Viya Postgresql for retraining...')
     dfs = extract()
-    logging.info('Transforming performance data for retraining...')
     train_df = transform(dfs)
     logging.info('Creating retrain file...')
     load(train_df)
@@ -12,17 +12,36 @@ Author: Ivan Nardini (ivan.nardini@sas.com)
 """
 
 import os
+import re
+import json
+import asyncio
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from multiprocessing.util import Finalize
 import yaml
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
 import uuid
 import time
 import logging
 
+from scoring_client import (ScoringClient, SavedModelClient, create_client, MicroBatcher, PredictionCache,
+                            RateLimiter)
+
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p',
                     level=logging.INFO)
 
+# Same format for all the timestamps of the csv log, whatever their fraction of second
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# Steps of a worker process, built on its first chunk and reused for the next ones
+WORKER_STEPS = {}
+
 
 # Helpers --------------------------------------------------------------------------------------------------------------
 def load_yaml (configpath: str) -> dict:
@@ -42,7 +61,8 @@ def get_data_list (datapath: str) -> list:
     :param datapath:
     :return: data_paths
     '''
-    data_filenames = os.listdir(datapath)
+    # Sort to replay the data files in a deterministic order
+    data_filenames = sorted(os.listdir(datapath))
     data_paths = [os.path.join(datapath, filename) for filename in data_filenames]
     return data_paths
 
@@ -54,12 +74,23 @@ def read_data (datapath: str, nrows=None) -> pd.DataFrame:
     :param nrows:
     :return: data
     '''
-    data = pd.read_csv(datapath, sep=',')
-    if nrows:
-        data = data[:nrows]
+    # Let the parser stop at nrows instead of reading the whole file
+    data = pd.read_csv(datapath, sep=',', nrows=nrows)
     return data
 
 
+def read_data_chunks (datapath: str, chunksize: int, nrows=None):
+    '''
+    Read csv in chunks of chunksize rows, up to nrows
+    :param datapath:
+    :param chunksize:
+    :param nrows:
+    :return: a generator of Dataframe. The index continues from one chunk to the next
+    '''
+    for data in pd.read_csv(datapath, sep=',', chunksize=chunksize, nrows=nrows):
+        yield data
+
+
 def set_target_predictors (dataframe: pd.DataFrame, target: str, inputs: list) -> tuple:
     '''
     Set target and predictors for scoring
@@ -75,42 +106,93 @@ def set_target_predictors (dataframe: pd.DataFrame, target: str, inputs: list) -
     return target, predictors
 
 
-def format_plain_input (string: str) -> str:
+def format_plain_input (string) -> str:
     '''
     Format plain input for scoring
-    :param string:
+    :param string: a record dictionary or a list of record dictionaries
     :return: format_record
     '''
-    # Format record because keys need double quote
-    format_string = str(string).replace("'", '"')
-    # Format nan with NaN cause JSON conformance
-    format_string = format_string.replace('nan', 'NaN')
-    # Create the record for scoring
-    plain_input_formatted = ''.join(['{"examples":[', format_string, ']}'])
+    # Accept a batch of records as well as a single record
+    records = string if isinstance(string, list) else [string]
+    # Missing values are serialized as NaN, which TF Serving JSON parser accepts
+    plain_input_formatted = json.dumps({'examples': records}, separators=(',', ':'), allow_nan=True)
     return plain_input_formatted
 
 
-def set_plain_inputs (raw_inputs: pd.DataFrame) -> list:
+def set_missing_values (raw_inputs: pd.DataFrame, nan_policy: str = 'nan'):
+    '''
+    Apply the missing values policy to the predictors
+    :param raw_inputs:
+    :param nan_policy: 'nan' keeps NaN, 'null' turns NaN into null, 'drop' removes missing features from the record
+    :return: records
+    '''
+    if nan_policy not in ('nan', 'null', 'drop'):
+        raise ValueError(f'Unknown nan_policy {nan_policy}. Use nan, null or drop')
+    if nan_policy == 'null':
+        raw_inputs = raw_inputs.astype(object).where(raw_inputs.notna(), None)
+    # Convert column by column to native Python values, then zip them in records
+    columns = raw_inputs.columns.tolist()
+    values = [raw_inputs[column].tolist() for column in columns]
+    records = [dict(zip(columns, row)) for row in zip(*values)]
+    if nan_policy == 'drop':
+        # NaN is the only value not equal to itself
+        records = [{column: value for column, value in record.items() if value == value} for record in records]
+    return records
+
+
+def serialize_examples (raw_inputs: pd.DataFrame, orient: str = 'records', nan_policy: str = 'nan') -> str:
+    '''
+    Serialize the predictors dataframe in a TF Serving JSON payload
+    :param raw_inputs:
+    :param orient: 'records' for the row format ({"examples": [...]}, classify and regress APIs),
+                   'columns' for the columnar format ({"inputs": {...}}, predict API)
+    :param nan_policy: 'nan' or 'null'. 'drop' is only available with the records orient
+    :return: payload
+    '''
+    if orient == 'records':
+        payload = {'examples': set_missing_values(raw_inputs, nan_policy)}
+    elif orient == 'columns':
+        if nan_policy == 'drop':
+            raise ValueError('Columnar payloads cannot drop missing values')
+        if nan_policy == 'null':
+            raw_inputs = raw_inputs.astype(object).where(raw_inputs.notna(), None)
+        payload = {'inputs': {column: raw_inputs[column].tolist() for column in raw_inputs.columns}}
+    else:
+        raise ValueError(f'Unknown orient {orient}. Use records or columns')
+    return json.dumps(payload, separators=(',', ':'), allow_nan=True)
+
+
+def set_batches (plain_inputs: list, batch_size: int = 1) -> list:
+    '''
+    Split the list of records in batches of batch_size records
+    :param plain_inputs:
+    :param batch_size:
+    :return: batches
+    '''
+    if batch_size < 1:
+        raise ValueError(f'batch_size must be a positive integer, got {batch_size}')
+    batches = [plain_inputs[i:i + batch_size] for i in range(0, len(plain_inputs), batch_size)]
+    return batches
+
+
+def set_plain_inputs (raw_inputs: pd.DataFrame, nan_policy: str = 'nan') -> list:
     '''
     Create a list of raw records dictionary
     :param raw_inputs:
+    :param nan_policy: how to handle missing values. See set_missing_values
     :return: plain_inputs
     '''
-    # Read dataframe
-    nrows = len(raw_inputs)
-    raw_inputs_dictionary = raw_inputs.to_dict()
-    # Create a list to store raw input records
-    plain_inputs = []
-    i = 0
-    while i < nrows:
-        # Create the column:value records dictionary to score
-        plain_input = {column: row[i] for column, row in raw_inputs_dictionary.items()}
-        plain_inputs.append(plain_input)
-        i += 1
+    plain_inputs = set_missing_values(raw_inputs, nan_policy)
     return plain_inputs
 
 
-def send_score_request (schema: str, ip: str, port: int, path: str, plain_input: list) -> str:
+class ScoringError(ValueError):
+    '''
+    A scoring reply that does not match the request
+    '''
+
+
+def send_score_request (schema: str, ip: str, port: int, path: str, plain_input: list, client=None) -> dict:
     '''
     Send API scoring request
     :param schema:
@@ -118,24 +200,114 @@ def send_score_request (schema: str, ip: str, port: int, path: str, plain_input:
     :param port:
     :param path:
     :param plain_input:
+    :param client: a ScoringClient, or a SavedModelClient to score in-process.
+                   If None, a new connection is opened for the request
     :return: output
     '''
+    # Score in-process, skipping HTTP and JSON
+    if isinstance(client, SavedModelClient):
+        return client.classify(plain_input)
     # Create url
     url = '{0}://{1}:{2}/{3}'.format(schema, ip, port, path)
     # Format record for scoring
     plain_input_formatted = format_plain_input(plain_input)
     # Send the request
-    try:
-        response = requests.post(url, data=plain_input_formatted)
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as error:
-        raise SystemExit(error)
-    else:
-        plain_output = response.json()
-        return plain_output
+    sender = client if client is not None else requests
+    # HTTP errors go up to the caller: main decides the exit code
+    response = sender.post(url, data=plain_input_formatted)
+    response.raise_for_status()
+    plain_output = response.json()
+    return plain_output
 
 
-def get_outputs_list (plain_inputs: list, schema: str, ip: str, port: int, path: str) -> list:
+def get_outputs_list_batcher (plain_inputs: list, batcher: MicroBatcher) -> list:
+    '''
+    Create a list of lists with infered labels and probabilities through the micro-batcher
+    :param plain_inputs:
+    :param batcher:
+    :return: output_lists
+    '''
+    futures = [batcher.submit(plain_input) for plain_input in plain_inputs]
+    outputs_list = [future.result() for future in futures]
+    return outputs_list
+
+
+def get_model_version (schema: str, ip: str, port: int, path: str, client=None) -> str:
+    '''
+    Get the model version served for path
+    :param schema:
+    :param ip:
+    :param port:
+    :param path:
+    :param client:
+    :return: version
+    '''
+    if isinstance(client, SavedModelClient):
+        return os.path.basename(client.model_path)
+    # v1/models/champion_model:classify -> v1/models/champion_model
+    url = '{0}://{1}:{2}/{3}'.format(schema, ip, port, path.split(':')[0])
+    sender = client if client is not None else requests
+    response = sender.get(url)
+    response.raise_for_status()
+    versions = [status['version'] for status in response.json()['model_version_status']
+                if status['state'] == 'AVAILABLE']
+    # TF Serving scores with the latest available version
+    version = max(versions, key=int) if versions else ''
+    return version
+
+
+def get_outputs_list_cached (plain_inputs: list, cache: PredictionCache, get_outputs) -> list:
+    '''
+    Create a list of lists with infered labels and probabilities, scoring only records not in cache.
+    Identical records are scored once.
+    :param plain_inputs:
+    :param cache:
+    :param get_outputs: a function scoring a list of records
+    :return: output_lists
+    '''
+    keys = [cache.get_key(plain_input) for plain_input in plain_inputs]
+    outputs_list = [None] * len(keys)
+    # Unique records to score, in order of appearance
+    misses = OrderedDict()
+    for i, key in enumerate(keys):
+        # A repeated record is scored once, with its first occurrence: the others are hits
+        if key in misses:
+            misses[key].append(i)
+            cache.count_hit()
+            continue
+        outputs_list[i] = cache.get(key)
+        if outputs_list[i] is None:
+            misses[key] = [i]
+    if misses:
+        miss_outputs = get_outputs([plain_inputs[positions[0]] for positions in misses.values()])
+        for (key, positions), output in zip(misses.items(), miss_outputs):
+            cache.put(key, output)
+            for i in positions:
+                outputs_list[i] = output
+    return outputs_list
+
+
+def get_batch_outputs (batch: list, schema: str, ip: str, port: int, path: str, client=None) -> list:
+    '''
+    Score a batch of records and return one result per record
+    :param batch:
+    :param schema:
+    :param ip:
+    :param port:
+    :param path:
+    :param client:
+    :return: results
+    '''
+    plain_output = send_score_request(schema, ip, port, path, batch, client)
+    results = plain_output['results']
+    # TF Serving returns one result per example, in the same order
+    if len(results) != len(batch):
+        raise ScoringError(f'Expected {len(batch)} results, got {len(results)}')
+    return results
+
+
+def get_outputs_list (plain_inputs: list, schema: str, ip: str, port: int, path: str, batch_size: int = 1,
+                      client=None) -> list:
     '''
     Create a list of lists with infered labels and probabilities
     :param plain_inputs:
@@ -143,65 +315,342 @@ def get_outputs_list (plain_inputs: list, schema: str, ip: str, port: int, path:
     :param ip:
     :param port:
     :param path:
+    :param batch_size: number of examples packed in each classify request
+    :param client:
     :return: output_lists
     '''
     outputs_list = []
-    for plain_input in plain_inputs:
-        # Make the request
-        plain_output = send_score_request(schema, ip, port, path, plain_input)
-        plain_output = plain_output['results'][0]
-        # Store each result in a list
-        outputs_list.append(plain_output)
+    for batch in set_batches(plain_inputs, batch_size):
+        # Make the request and store each result in a list
+        outputs_list.extend(get_batch_outputs(batch, schema, ip, port, path, client))
     return outputs_list
 
 
-def set_outputs_dataframe (outputs_list: list, outputs: list) -> pd.DataFrame:
+async def score_batches_async (batches: list, schema: str, ip: str, port: int, path: str, client=None,
+                               concurrency: int = 1, limiter: RateLimiter = None) -> list:
     '''
-    Set a dictionary with infered labels and probabilities
-    :param outputs_list:
+    Score batches concurrently with at most concurrency requests in flight
+    :param batches:
+    :param schema:
+    :param ip:
+    :param port:
+    :param path:
+    :param client:
+    :param concurrency: max number of in-flight requests
+    :param limiter: RateLimiter of the run. If None, no rate limit
+    :return: batch_outputs in the same order of batches
+    '''
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        async def score_batch (batch):
+            async with semaphore:
+                if limiter:
+                    await limiter.wait()
+                return await loop.run_in_executor(executor, get_batch_outputs,
+                                                  batch, schema, ip, port, path, client)
+
+        # gather keeps the order of the batches whatever the completion order is.
+        # Wait for all of them, so that no failed request is left unretrieved, then raise the first failure
+        batch_outputs = await asyncio.gather(*[score_batch(batch) for batch in batches], return_exceptions=True)
+    errors = [outputs for outputs in batch_outputs if isinstance(outputs, Exception)]
+    if errors:
+        raise errors[0]
+    return batch_outputs
+
+
+def get_outputs_list_async (plain_inputs: list, schema: str, ip: str, port: int, path: str, batch_size: int = 1,
+                            client=None, concurrency: int = 1, limiter: RateLimiter = None) -> list:
+    '''
+    Create a list of lists with infered labels and probabilities sending concurrent requests
+    :param plain_inputs:
+    :param schema:
+    :param ip:
+    :param port:
+    :param path:
+    :param batch_size: number of examples packed in each classify request
+    :param client:
+    :param concurrency: max number of in-flight requests
+    :param limiter: RateLimiter of the run. If None, no rate limit
+    :return: output_lists
+    '''
+    batches = set_batches(plain_inputs, batch_size)
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        batch_outputs = loop.run_until_complete(
+            score_batches_async(batches, schema, ip, port, path, client, concurrency, limiter))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    outputs_list = [result for results in batch_outputs for result in results]
+    return outputs_list
+
+
+def set_outputs_dataframe (outputs_list: list, outputs: list, index=None, threshold: float = 0.5) -> pd.DataFrame:
+    '''
+    Set a dataframe with infered labels and probabilities
+    :param outputs_list: classify results, one [[label0, score0], [label1, score1]] pair per record
     :param outputs:
+    :param index: index of the scored records, to join outputs with input data
+    :param threshold: event probability from which the record is classified as event
     :return: outputs_dataframe
     '''
-    output_dictionaries_list = []
-    for output_row in outputs_list:
-        output_dictionary = {}
+    # Stack the score pairs in a (n, 2) array
+    if len(outputs_list):
+        scores = np.asarray(outputs_list, dtype=object)[:, :, 1].astype(float)
+    else:
+        scores = np.empty((0, 2))
+    outputs_dataframe = pd.DataFrame({
         # no_default_probability
-        output_dictionary[outputs[0]] = output_row[0][1]
+        outputs[0]: scores[:, 0],
         # default_probabality
-        output_dictionary[outputs[1]] = output_row[1][1]
+        outputs[1]: scores[:, 1],
         # em_probability
-        output_dictionary[outputs[2]] = output_row[0][1] if output_row[0][1] > output_row[1][1] else output_row[1][1]
+        outputs[2]: scores.max(axis=1),
         # em_class
-        output_dictionary[outputs[3]] = 0 if output_row[0][1] > 0.5 else 1
-        output_dictionaries_list.append(output_dictionary)
-    outputs_dataframe = pd.DataFrame(output_dictionaries_list)
+        outputs[3]: (scores[:, 1] >= threshold).astype(int)
+    }, index=index)
     return outputs_dataframe
 
 
-def set_logging_dataframe (data: pd.DataFrame, outputs: pd.DataFrame) -> pd.DataFrame:
+def get_model_targets (model_endpoint_meta: dict) -> list:
+    '''
+    Return the models to score with. Without targets, the model at path
+    :param model_endpoint_meta:
+    :return: list of (name, path)
+    '''
+    targets = model_endpoint_meta.get('targets')
+    if not targets:
+        return [(None, model_endpoint_meta['path'])]
+    return [(target['name'], target['path']) for target in targets]
+
+
+def get_target_output_names (outputs: list, name: str, primary: bool) -> list:
+    '''
+    Name the output columns of a target.
+    The first target keeps the output names, so the log stays readable by the performance jobs.
+    :param outputs:
+    :param name:
+    :param primary:
+    :return: output_names
+    '''
+    if primary or not name:
+        return outputs
+    return [f'{output}_{name}' for output in outputs]
+
+
+def set_logging_dataframe (data: pd.DataFrame, outputs: pd.DataFrame, timestamp_column: str = None,
+                           request_id_column: str = None) -> pd.DataFrame:
     '''
     Join target, inputs and outputs based on index
     :param target:
     :param inputs:
     :param outputs:
+    :param timestamp_column: if not None, column of the scoring timestamp (UTC)
+    :param request_id_column: if not None, column of a unique id for each scored row
     :return: logDf
     '''
     # Left merge with input data
     logDf = pd.merge(data, outputs, how='inner', left_index=True, right_index=True)
+    if timestamp_column:
+        logDf[timestamp_column] = pd.Timestamp.now(tz='UTC').tz_localize(None)
+    if request_id_column:
+        logDf[request_id_column] = [uuid.uuid4().hex for _ in range(len(logDf))]
     return logDf
 
 
-def write_log (logdataframes: list, logpath: str):
+def get_log_schema (logdf: pd.DataFrame, variables_schema_meta: dict) -> pa.Schema:
+    '''
+    Define the columnar log schema.
+    Target and classification are integers, inputs and probabilities are doubles,
+    other columns follow their pandas type (text columns are strings).
+    :param logdf:
+    :param variables_schema_meta:
+    :return: schema
     '''
-    Write the log.csv file
+    outputs = variables_schema_meta['outputs']
+    types = {variables_schema_meta['target']: pa.int64()}
+    types.update({column: pa.float64() for column in variables_schema_meta['inputs'] + outputs[:3]})
+    types[outputs[3]] = pa.int64()
+    fields = []
+    for column, dtype in logdf.dtypes.items():
+        # Challenger outputs are named <output>_<model name>
+        field_type = types.get(column, types.get(column.rsplit('_', 1)[0]))
+        if field_type is None:
+            if pd.api.types.is_bool_dtype(dtype):
+                field_type = pa.bool_()
+            elif pd.api.types.is_integer_dtype(dtype):
+                field_type = pa.int64()
+            elif pd.api.types.is_float_dtype(dtype):
+                field_type = pa.float64()
+            elif pd.api.types.is_datetime64_dtype(dtype):
+                field_type = pa.timestamp('us')
+            else:
+                field_type = pa.string()
+        fields.append(pa.field(column, field_type))
+    return pa.schema(fields)
+
+
+def get_log_table (logdf: pd.DataFrame, schema: pa.Schema) -> pa.Table:
+    '''
+    Convert the log dataframe in an arrow table
+    :param logdf:
+    :param schema:
+    :return: table
+    '''
+    table = pa.Table.from_pandas(logdf, schema=schema, preserve_index=False)
+    return table
+
+
+def write_log (logdataframes: list, logpath: str, logformat: str = 'csv', variables_schema_meta: dict = None):
+    '''
+    Write the log.csv file, or the log.parquet file for the parquet format.
+    The log is written in a .part file which is atomically renamed when complete,
+    as LogWriter does, so the logging agent never reads a half-written or truncated log
     :param logdataframes:
     :param logpath:
+    :param logformat: csv or parquet
+    :param variables_schema_meta: schema of the parquet log
     :return:
     '''
     full_logdf = pd.concat(logdataframes)
-    logname = 'log.csv'
+    logname = f'log.{logformat}'
     fulllogpath = f'{logpath}{logname}'
-    full_logdf.to_csv(fulllogpath, sep=',', index=False)
+    partlogpath = f'{fulllogpath}.part'
+    if logformat == 'parquet':
+        schema = get_log_schema(full_logdf, variables_schema_meta)
+        pq.write_table(get_log_table(full_logdf, schema), partlogpath)
+    else:
+        full_logdf.to_csv(partlogpath, sep=',', index=False, date_format=LOG_DATE_FORMAT)
+    with open(partlogpath, 'a') as file:
+        os.fsync(file.fileno())
+    os.replace(partlogpath, fulllogpath)
+
+
+class LogWriter:
+    '''
+    Append scored chunks to the log as soon as they are ready.
+    Rows are appended to a .part file which is atomically renamed when complete,
+    so the logging agent never reads a half-written log.
+    Without thresholds, a single log.csv is published on close.
+    With a size or time threshold, the log rotates over log_00001.csv, log_00002.csv, ... segments.
+    With the parquet format, each chunk is a row group of log.parquet (or of log_00001.parquet, ...).
+    '''
+
+    def __init__ (self, logpath: str, logname: str = None, max_bytes: int = None, max_seconds: float = None,
+                  logformat: str = 'csv', variables_schema_meta: dict = None):
+        '''
+        :param logpath:
+        :param logname: default log.<logformat>
+        :param max_bytes: rotate the segment when it reaches max_bytes
+        :param max_seconds: rotate the segment when it is older than max_seconds
+        :param logformat: csv or parquet
+        :param variables_schema_meta: schema of the parquet log
+        '''
+        if logformat not in ('csv', 'parquet'):
+            raise ValueError(f'Unknown log format {logformat}. Use csv or parquet')
+        self.logpath = logpath
+        self.logname = logname or f'log.{logformat}'
+        self.logformat = logformat
+        self.variables_schema_meta = variables_schema_meta
+        self.schema = None
+        self.parquet_writer = None
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.rotate = bool(max_bytes or max_seconds)
+        self.nrows = 0
+        # Go on from the last published segment, so unread segments are never overwritten
+        self.segment = get_last_segment(logpath, self.logname) if self.rotate else 0
+        self.open_segment()
+
+    def get_segment_path (self, segment: int) -> str:
+        '''
+        Return the path of a segment
+        :param segment:
+        :return: fulllogpath
+        '''
+        if not self.rotate:
+            return f'{self.logpath}{self.logname}'
+        name, extension = os.path.splitext(self.logname)
+        return f'{self.logpath}{name}_{segment:05d}{extension}'
+
+    def open_segment (self):
+        '''
+        Start a new segment
+        '''
+        self.segment += 1
+        self.fulllogpath = self.get_segment_path(self.segment)
+        self.partlogpath = f'{self.fulllogpath}.part'
+        self.segment_nrows = 0
+        self.segment_start = time.time()
+        # Drop the leftovers of an interrupted run
+        if os.path.exists(self.partlogpath):
+            os.remove(self.partlogpath)
+
+    def is_full (self) -> bool:
+        '''
+        Check the rotation thresholds
+        :return: is_full
+        '''
+        if self.max_bytes and os.path.getsize(self.partlogpath) >= self.max_bytes:
+            return True
+        if self.max_seconds and time.time() - self.segment_start >= self.max_seconds:
+            return True
+        return False
+
+    def publish (self):
+        '''
+        Make the current segment visible to readers
+        '''
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+            self.parquet_writer = None
+        if os.path.exists(self.partlogpath):
+            with open(self.partlogpath, 'a') as file:
+                os.fsync(file.fileno())
+            os.replace(self.partlogpath, self.fulllogpath)
+
+    def append (self, logdf: pd.DataFrame):
+        '''
+        Append a scored chunk. The header is written once for each segment
+        :param logdf:
+        '''
+        if self.logformat == 'parquet':
+            # Same schema for all the chunks, whatever types pandas infers for each of them
+            if self.schema is None:
+                self.schema = get_log_schema(logdf, self.variables_schema_meta)
+            if self.parquet_writer is None:
+                self.parquet_writer = pq.ParquetWriter(self.partlogpath, self.schema)
+            self.parquet_writer.write_table(get_log_table(logdf, self.schema))
+        else:
+            logdf.to_csv(self.partlogpath, sep=',', index=False, mode='a', header=self.segment_nrows == 0,
+                         date_format=LOG_DATE_FORMAT)
+        self.segment_nrows += len(logdf)
+        self.nrows += len(logdf)
+        if self.rotate and self.is_full():
+            self.publish()
+            self.open_segment()
+
+    def close (self):
+        '''
+        Publish the last segment
+        '''
+        self.publish()
+
+
+def get_last_segment (logpath: str, logname: str) -> int:
+    '''
+    Return the sequence number of the last published log segment
+    :param logpath:
+    :param logname:
+    :return: segment
+    '''
+    name, extension = os.path.splitext(logname)
+    pattern = re.compile(rf'^{re.escape(name)}_(\d+){re.escape(extension)}$')
+    segments = [int(match.group(1)) for match in map(pattern.match, os.listdir(logpath)) if match]
+    return max(segments, default=0)
 
 
 def print_logs (logDf, nrows) -> list:
@@ -228,6 +677,7 @@ def print_logs (logDf, nrows) -> list:
 # Build process steps --------------------------------------------------------------------------------------------------
 def build_load (config, nrows):
     VARIABLE_SCHEMA_META = config['variables_schema_meta']
+    NAN_POLICY = config['model_endpoint_meta'].get('nan_policy', 'nan')
     NROWS = nrows
 
     def load (datafile: str):
@@ -244,42 +694,178 @@ def build_load (config, nrows):
                                                VARIABLE_SCHEMA_META['target'],
                                                VARIABLE_SCHEMA_META['inputs'])
 
-        plain_inputs = set_plain_inputs(inputs)
+        plain_inputs = set_plain_inputs(inputs, NAN_POLICY)
 
         return data, plain_inputs
 
     return load
 
 
+def build_load_chunks (config, nrows, chunksize):
+    VARIABLE_SCHEMA_META = config['variables_schema_meta']
+    NAN_POLICY = config['model_endpoint_meta'].get('nan_policy', 'nan')
+    NROWS = nrows
+    CHUNKSIZE = chunksize
+
+    def load_chunks (datafile: str):
+        '''
+        Load process, one chunk at a time
+        :param datafile:
+        :return: a generator of data, plain_inputs
+        '''
+        for data in read_data_chunks(datafile, CHUNKSIZE, nrows=NROWS):
+            target, inputs = set_target_predictors(data,
+                                                   VARIABLE_SCHEMA_META['target'],
+                                                   VARIABLE_SCHEMA_META['inputs'])
+
+            plain_inputs = set_plain_inputs(inputs, NAN_POLICY)
+
+            yield data, plain_inputs
+
+    return load_chunks
+
+
+def build_get_outputs (config, path, client, limiter=None):
+    MODEL_ENDPOINT_META = config['model_endpoint_meta']
+    SCORING_META = config.get('scoring_meta', {})
+    BATCH_SIZE = MODEL_ENDPOINT_META.get('batch_size', 1)
+    CONCURRENCY = SCORING_META.get('concurrency', 1)
+    LIMITER = limiter
+    CACHE_META = config.get('cache_meta', {})
+    CACHE = PredictionCache(CACHE_META.get('max_size', 100000),
+                            CACHE_META.get('ttl', 3600),
+                            CACHE_META.get('version_check_seconds', 30)) if CACHE_META.get('enabled') else None
+    BATCHER = MicroBatcher(partial(get_batch_outputs,
+                                   schema=MODEL_ENDPOINT_META['schema'],
+                                   ip=MODEL_ENDPOINT_META['ip'],
+                                   port=MODEL_ENDPOINT_META['port'],
+                                   path=path,
+                                   client=client),
+                           SCORING_META.get('max_batch_size', 64),
+                           SCORING_META.get('max_wait_ms', 5) / 1000,
+                           CONCURRENCY,
+                           LIMITER) if SCORING_META.get('micro_batching') else None
+
+    def get_outputs (plain_inputs):
+        if BATCHER:
+            scored_data_list = get_outputs_list_batcher(plain_inputs, BATCHER)
+            logging.info(f'Micro-batching stats for {path}: {BATCHER.get_stats()}')
+        elif CONCURRENCY > 1 or LIMITER:
+            scored_data_list = get_outputs_list_async(plain_inputs,
+                                                      MODEL_ENDPOINT_META['schema'],
+                                                      MODEL_ENDPOINT_META['ip'],
+                                                      MODEL_ENDPOINT_META['port'],
+                                                      path,
+                                                      BATCH_SIZE,
+                                                      client,
+                                                      CONCURRENCY,
+                                                      LIMITER)
+        else:
+            scored_data_list = get_outputs_list(plain_inputs,
+                                                MODEL_ENDPOINT_META['schema'],
+                                                MODEL_ENDPOINT_META['ip'],
+                                                MODEL_ENDPOINT_META['port'],
+                                                path,
+                                                BATCH_SIZE,
+                                                client)
+        return scored_data_list
+
+    def get_version ():
+        return get_model_version(MODEL_ENDPOINT_META['schema'],
+                                 MODEL_ENDPOINT_META['ip'],
+                                 MODEL_ENDPOINT_META['port'],
+                                 path,
+                                 client)
+
+    def get_target_outputs (plain_inputs):
+        '''
+        Score the records with the model served at path
+        :param plain_inputs:
+        :return: output_lists
+        '''
+        if CACHE:
+            CACHE.check_version(get_version)
+            scored_data_list = get_outputs_list_cached(plain_inputs, CACHE, get_outputs)
+            logging.info(f'Prediction cache stats for {path}: {CACHE.get_stats()}')
+        else:
+            scored_data_list = get_outputs(plain_inputs)
+        return scored_data_list
+
+    def close ():
+        '''
+        Score the records left in the micro-batcher and stop its threads
+        '''
+        if BATCHER:
+            BATCHER.close()
+
+    get_target_outputs.close = close
+    return get_target_outputs
+
+
 def build_score (config):
     MODEL_ENDPOINT_META = config['model_endpoint_meta']
     VARIABLE_SCHEMA_META = config['variables_schema_meta']
+    SCORING_META = config.get('scoring_meta', {})
+    THRESHOLD = SCORING_META.get('threshold', 0.5)
+    # One pooled client for the whole run
+    CLIENT = create_client(MODEL_ENDPOINT_META)
+    # One rate limiter for all the targets. Worker processes share the limit
+    RATE_LIMIT = SCORING_META.get('rate_limit')
+    LIMITER = RateLimiter(RATE_LIMIT / SCORING_META.get('processes', 1)) if RATE_LIMIT else None
+    TARGETS = get_model_targets(MODEL_ENDPOINT_META)
+    GET_OUTPUTS = [build_get_outputs(config, path, CLIENT, LIMITER) for _, path in TARGETS]
+    # Score all the targets at the same time
+    TARGETS_EXECUTOR = ThreadPoolExecutor(max_workers=len(TARGETS)) if len(TARGETS) > 1 else None
 
-    def score (plain_inputs):
+    def score (plain_inputs, index=None):
         '''
         Score process
-        :param datafile:
-        :param nrows:
-        :return: logDf
+        :param plain_inputs:
+        :param index:
+        :return: outputs
         '''
 
-        scored_data_list = get_outputs_list(plain_inputs,
-                                            MODEL_ENDPOINT_META['schema'],
-                                            MODEL_ENDPOINT_META['ip'],
-                                            MODEL_ENDPOINT_META['port'],
-                                            MODEL_ENDPOINT_META['path'])
+        if TARGETS_EXECUTOR:
+            futures = [TARGETS_EXECUTOR.submit(get_outputs, plain_inputs) for get_outputs in GET_OUTPUTS]
+            scored_data_lists = [future.result() for future in futures]
+        else:
+            scored_data_lists = [GET_OUTPUTS[0](plain_inputs)]
 
-        outputs = set_outputs_dataframe(scored_data_list,
-                                        VARIABLE_SCHEMA_META['outputs'])
+        if getattr(CLIENT, 'balancer', None):
+            logging.info(f'Model server stats: {CLIENT.balancer.get_stats()}')
+        if getattr(CLIENT, 'hedging', None):
+            logging.info(f'Hedging stats: {CLIENT.hedging.get_stats()}')
+
+        outputs = [set_outputs_dataframe(scored_data_list,
+                                         get_target_output_names(VARIABLE_SCHEMA_META['outputs'], name, i == 0),
+                                         index,
+                                         THRESHOLD)
+                   for i, ((name, _), scored_data_list) in enumerate(zip(TARGETS, scored_data_lists))]
+        outputs = pd.concat(outputs, axis=1) if len(outputs) > 1 else outputs[0]
 
         return outputs
 
+    def close ():
+        '''
+        Stop the micro-batchers and the targets executor, and close the client connections
+        '''
+        for get_outputs in GET_OUTPUTS:
+            get_outputs.close()
+        if TARGETS_EXECUTOR:
+            TARGETS_EXECUTOR.shutdown(wait=True)
+        if isinstance(CLIENT, ScoringClient):
+            CLIENT.close()
+
+    score.close = close
     return score
 
 
-def build_log ():
+def build_log (config):
+    TIMESTAMP_COLUMN = config['logging_meta'].get('timestamp_column')
+    REQUEST_ID_COLUMN = config['logging_meta'].get('request_id_column')
+
     def log (data, outputs):
-        logDf = set_logging_dataframe(data, outputs)
+        logDf = set_logging_dataframe(data, outputs, TIMESTAMP_COLUMN, REQUEST_ID_COLUMN)
         return logDf
 
     return log
@@ -287,13 +873,25 @@ def build_log ():
 
 def build_write (config):
     LOGPATH = config['logging_meta']['logpath']
+    LOGFORMAT = config['logging_meta'].get('format', 'csv')
+    VARIABLE_SCHEMA_META = config['variables_schema_meta']
 
     def write (logdfs):
-        write_log(logdfs, LOGPATH)
+        write_log(logdfs, LOGPATH, LOGFORMAT, VARIABLE_SCHEMA_META)
 
     return write
 
 
+def build_log_writer (config):
+    LOGGING_META = config['logging_meta']
+    log_writer = LogWriter(LOGGING_META['logpath'],
+                           max_bytes=LOGGING_META.get('segment_max_bytes'),
+                           max_seconds=LOGGING_META.get('segment_max_seconds'),
+                           logformat=LOGGING_META.get('format', 'csv'),
+                           variables_schema_meta=config['variables_schema_meta'])
+    return log_writer
+
+
 def iterator (config, load, score, log) -> list:
     '''
     An iterator of the steps.
@@ -309,31 +907,171 @@ def iterator (config, load, score, log) -> list:
 
     for i, datafile in enumerate(data_sources, start=1):
         data, plain_inputs = load(datafile)
-        outputs = score(plain_inputs)
+        outputs = score(plain_inputs, data.index)
         logdf = log(data, outputs)
         log_dfs.append(logdf)
     return log_dfs
 
 
+def stream_iterator (config, load_chunks, score, log, log_writer) -> int:
+    '''
+    A streaming iterator of the steps.
+    Each chunk is loaded, scored and appended to the log before reading the next one,
+    so memory is bounded by the chunk size.
+    :param config:
+    :param load_chunks:
+    :param score:
+    :param log:
+    :param log_writer:
+    :return: nrows scored
+    '''
+    datapath = config['data_meta']['datapath']
+    data_sources = get_data_list(datapath)
+
+    for datafile in data_sources:
+        for data, plain_inputs in load_chunks(datafile):
+            outputs = score(plain_inputs, data.index)
+            logdf = log(data, outputs)
+            log_writer.append(logdf)
+            logging.info(f'Scored {len(logdf)} rows of {datafile}. {log_writer.nrows} rows logged')
+    return log_writer.nrows
+
+
+def score_datafile (config: dict, nrows: int, datafile: str) -> pd.DataFrame:
+    '''
+    Load, score and log a single data file.
+    It builds its own steps (and so its own scoring client) to run in a worker process.
+    :param config:
+    :param nrows:
+    :param datafile:
+    :return: logdf
+    '''
+    load = build_load(config, nrows)
+    score = build_score(config)
+    log = build_log(config)
+    try:
+        data, plain_inputs = load(datafile)
+        outputs = score(plain_inputs, data.index)
+    finally:
+        score.close()
+    logdf = log(data, outputs)
+    return logdf
+
+
+def score_chunk (config: dict, plain_inputs: list, index) -> pd.DataFrame:
+    '''
+    Score a single chunk in a worker process.
+    The worker builds its scoring step (and so its scoring client) once, on its first chunk.
+    :param config:
+    :param plain_inputs:
+    :param index:
+    :return: outputs
+    '''
+    if 'score' not in WORKER_STEPS:
+        WORKER_STEPS['score'] = build_score(config)
+        # The worker keeps its scoring step until the pool shuts it down: close it on the way out
+        Finalize(None, WORKER_STEPS['score'].close, exitpriority=10)
+    outputs = WORKER_STEPS['score'](plain_inputs, index)
+    return outputs
+
+
+def parallel_stream_iterator (config, load_chunks, log, log_writer, processes) -> int:
+    '''
+    A streaming iterator of the steps over a pool of processes.
+    Chunks are read here and scored by the workers, at most 2 * processes at a time,
+    then appended to the log in reading order, so memory stays bounded by the chunk size.
+    :param config:
+    :param load_chunks:
+    :param log:
+    :param log_writer:
+    :param processes: number of worker processes
+    :return: nrows scored
+    '''
+    datapath = config['data_meta']['datapath']
+    data_sources = get_data_list(datapath)
+    pending = deque()
+
+    def append_next ():
+        datafile, data, future = pending.popleft()
+        logdf = log(data, future.result())
+        log_writer.append(logdf)
+        logging.info(f'Scored {len(logdf)} rows of {datafile}. {log_writer.nrows} rows logged')
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for datafile in data_sources:
+            for data, plain_inputs in load_chunks(datafile):
+                pending.append((datafile, data, executor.submit(score_chunk, config, plain_inputs, data.index)))
+                if len(pending) >= 2 * processes:
+                    append_next()
+        while pending:
+            append_next()
+    return log_writer.nrows
+
+
+def parallel_iterator (config, nrows, processes) -> list:
+    '''
+    Run the steps on each data file in a pool of processes.
+    :param config:
+    :param nrows:
+    :param processes: number of worker processes
+    :return: log_dataframes in the same order of the data files
+    '''
+    datapath = config['data_meta']['datapath']
+    data_sources = get_data_list(datapath)
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        log_dfs = list(executor.map(partial(score_datafile, config, nrows), data_sources))
+    return log_dfs
+
+
 def main ():
     # Read configuration ----------------------------------------
     logging.info('Loading scoring configuration file...')
     CONFIGPATH = './config/config.yaml'
     CONFIG = load_yaml(CONFIGPATH)
-    NROWS = 1000
+    NROWS = CONFIG['data_meta'].get('nrows', 1000)
+    CHUNKSIZE = CONFIG['data_meta'].get('chunksize')
+    PROCESSES = CONFIG.get('scoring_meta', {}).get('processes', 1)
 
     # Build methods ---------------------------------------------
     logging.info('Building methods...')
     load = build_load(CONFIG, NROWS)
-    score = build_score(CONFIG)
-    log = build_log()
+    # With more than one process, each worker builds its own scoring step
+    score = build_score(CONFIG) if PROCESSES == 1 else None
+    log = build_log(CONFIG)
     write = build_write(CONFIG)
 
-    # Iterate the process ---------------------------------------
-    # Notice we can consider to parallelize the process
-    # But for the demo purpose it is ok
-    logging.info('Initiating scoring process...')
-    log_dataframes = iterator(CONFIG, load, score, log)
+    # A failed scoring request stops the run with exit code 1
+    try:
+        # Stream the process ----------------------------------------
+        # With a chunksize, scored chunks are written as they are ready.
+        # With more than one process, the workers score the chunks read here
+        if CHUNKSIZE:
+            logging.info('Initiating streaming scoring process...')
+            load_chunks = build_load_chunks(CONFIG, NROWS, CHUNKSIZE)
+            log_writer = build_log_writer(CONFIG)
+            if PROCESSES > 1:
+                nrows = parallel_stream_iterator(CONFIG, load_chunks, log, log_writer, PROCESSES)
+            else:
+                nrows = stream_iterator(CONFIG, load_chunks, score, log, log_writer)
+            log_writer.close()
+            logging.info(f'Logfile created with {nrows} rows!')
+            return
+
+        # Iterate the process ---------------------------------------
+        # With more than one process, each data file is scored by its own worker
+        logging.info('Initiating scoring process...')
+        if PROCESSES > 1:
+            log_dataframes = parallel_iterator(CONFIG, NROWS, PROCESSES)
+        else:
+            log_dataframes = iterator(CONFIG, load, score, log)
+    # HTTP, connection and timeout errors left after the retries, or unexpected replies
+    except (requests.exceptions.RequestException, ScoringError) as error:
+        logging.error(f'Scoring request failed: {error}')
+        raise SystemExit(1)
+    finally:
+        if score:
+            score.close()
 
     # Write log file --------------------------------------------
     logging.info('Creating log file...')
@@ -0,0 +1,224 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+load_generator is an application to put load on the champion model endpoint
+replaying the performance data with the api_caller_model steps.
+Requests are sent open-loop at a target QPS, with a linear ramp-up: the send time of each
+request is fixed in advance and latency is measured from that time, so a slow server
+cannot hold the load back (no coordinated omission).
+Steps:
+1- Load the data and split it in requests
+2- Send the requests on schedule
+3- Write the latency report
+"""
+
+import json
+import math
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+from api_caller_model import load_yaml, get_data_list, set_batches, get_batch_outputs, build_load
+from scoring_client import create_client
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p',
+                    level=logging.INFO)
+
+
+# Helpers --------------------------------------------------------------------------------------------------------------
+def get_send_times (nrequests: int, qps: float, ramp_up: float = 0) -> np.ndarray:
+    '''
+    Compute the send time of each request, in seconds from the start.
+    The rate grows linearly from 0 to qps during ramp_up seconds, then stays at qps.
+    :param nrequests:
+    :param qps:
+    :param ramp_up:
+    :return: send_times
+    '''
+    requests_idx = np.arange(nrequests, dtype=float)
+    if not ramp_up:
+        return requests_idx / qps
+    # Requests sent during the ramp-up: qps * ramp_up / 2
+    ramp_requests = qps * ramp_up / 2
+    send_times = np.where(requests_idx < ramp_requests,
+                          np.sqrt(2 * ramp_up * requests_idx / qps),
+                          ramp_up / 2 + requests_idx / qps)
+    return send_times
+
+
+def send_timed_request (batch: list, scheduled: float, start: float, model_endpoint_meta: dict, client) -> tuple:
+    '''
+    Send a scoring request and measure its latency from the scheduled send time
+    :param batch:
+    :param scheduled: scheduled send time, in seconds from start
+    :param start: perf_counter at the start of the run
+    :param model_endpoint_meta:
+    :param client:
+    :return: scheduled, latency, error
+    '''
+    error = ''
+    try:
+        get_batch_outputs(batch,
+                          model_endpoint_meta['schema'],
+                          model_endpoint_meta['ip'],
+                          model_endpoint_meta['port'],
+                          model_endpoint_meta['path'],
+                          client)
+    # Count HTTP and connection errors as failed requests
+    except Exception as exception:
+        error = str(exception) or type(exception).__name__
+    latency = time.perf_counter() - start - scheduled
+    return scheduled, latency, error
+
+
+def run_open_loop (batches: list, send_times: np.ndarray, model_endpoint_meta: dict, client,
+                   max_in_flight: int) -> tuple:
+    '''
+    Send each batch at its send time, whatever the number of pending requests
+    :param batches:
+    :param send_times:
+    :param model_endpoint_meta:
+    :param client:
+    :param max_in_flight: size of the sender thread pool
+    :return: samples, one row per request, and duration in seconds
+    '''
+    futures = []
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        start = time.perf_counter()
+        for batch, scheduled in zip(batches, send_times):
+            delay = scheduled - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(send_timed_request, batch, scheduled, start, model_endpoint_meta, client))
+        samples = [future.result() for future in futures]
+        duration = time.perf_counter() - start
+    samples = pd.DataFrame(samples, columns=['scheduled', 'latency', 'error'])
+    return samples, duration
+
+
+def summarize_samples (samples: pd.DataFrame, duration: float, qps: float, batch_size: int) -> dict:
+    '''
+    Compute latency percentiles, throughput and error rate
+    :param samples:
+    :param duration:
+    :param qps: target QPS
+    :param batch_size:
+    :return: report
+    '''
+    errors = samples['error'] != ''
+    latencies = samples.loc[~errors, 'latency'].to_numpy() * 1000
+    percentiles = np.percentile(latencies, [50, 95, 99]) if len(latencies) else [math.nan] * 3
+    report = {
+        'target_qps': qps,
+        'requests': len(samples),
+        'batch_size': batch_size,
+        'duration_s': round(duration, 3),
+        'throughput_qps': round(len(samples) / duration, 3),
+        'throughput_records_s': round(len(samples) * batch_size / duration, 3),
+        'error_rate': round(float(errors.mean()), 6) if len(samples) else 0.0,
+        'latency_p50_ms': round(float(percentiles[0]), 3),
+        'latency_p95_ms': round(float(percentiles[1]), 3),
+        'latency_p99_ms': round(float(percentiles[2]), 3),
+        'latency_max_ms': round(float(latencies.max()), 3) if len(latencies) else math.nan
+    }
+    return report
+
+
+def write_report (report: dict, samples: pd.DataFrame, reportpath: str):
+    '''
+    Write the report as json and the request samples as csv
+    :param report:
+    :param samples:
+    :param reportpath:
+    :return:
+    '''
+    with open(f'{reportpath}load_report.json', 'w') as file:
+        json.dump(report, file, indent=2)
+    samples.to_csv(f'{reportpath}load_samples.csv', sep=',', index=False)
+
+
+# Build process steps --------------------------------------------------------------------------------------------------
+def build_requests (config):
+    LOAD_META = config['load_meta']
+    BATCH_SIZE = config['model_endpoint_meta'].get('batch_size', 1)
+    load = build_load(config, LOAD_META.get('nrows'))
+
+    def get_requests () -> list:
+        '''
+        Replay the data files as a list of request batches, up to max_requests
+        :return: batches
+        '''
+        datapath = config['data_meta']['datapath']
+        batches = []
+        for datafile in get_data_list(datapath):
+            data, plain_inputs = load(datafile)
+            batches.extend(set_batches(plain_inputs, BATCH_SIZE))
+        max_requests = LOAD_META.get('max_requests')
+        return batches[:max_requests] if max_requests else batches
+
+    return get_requests
+
+
+def build_run (config):
+    LOAD_META = config['load_meta']
+    MODEL_ENDPOINT_META = config['model_endpoint_meta']
+    CLIENT = create_client(MODEL_ENDPOINT_META)
+
+    def run (batches: list) -> tuple:
+        '''
+        Send the batches on schedule
+        :param batches:
+        :return: samples, duration, client
+        '''
+        send_times = get_send_times(len(batches), LOAD_META['qps'], LOAD_META.get('ramp_up', 0))
+        samples, duration = run_open_loop(batches, send_times, MODEL_ENDPOINT_META, CLIENT,
+                                          LOAD_META.get('max_in_flight', 64))
+        return samples, duration, CLIENT
+
+    return run
+
+
+def build_report (config):
+    LOAD_META = config['load_meta']
+    BATCH_SIZE = config['model_endpoint_meta'].get('batch_size', 1)
+
+    def report (samples: pd.DataFrame, duration: float, client) -> dict:
+        summary = summarize_samples(samples, duration, LOAD_META['qps'], BATCH_SIZE)
+        if getattr(client, 'balancer', None):
+            summary['endpoints'] = client.balancer.get_stats()
+        if getattr(client, 'hedging', None):
+            summary['hedging'] = client.hedging.get_stats()
+        write_report(summary, samples, LOAD_META['reportpath'])
+        return summary
+
+    return report
+
+
+def main ():
+    # Read configuration ----------------------------------------
+    logging.info('Loading scoring configuration file...')
+    CONFIGPATH = './config/config.yaml'
+    CONFIG = load_yaml(CONFIGPATH)
+
+    # Build methods ---------------------------------------------
+    logging.info('Building methods...')
+    get_requests = build_requests(CONFIG)
+    run = build_run(CONFIG)
+    report = build_report(CONFIG)
+
+    # Run the load ----------------------------------------------
+    batches = get_requests()
+    logging.info(f'Sending {len(batches)} requests at {CONFIG["load_meta"]["qps"]} QPS...')
+    samples, duration, client = run(batches)
+
+    # Write report ----------------------------------------------
+    summary = report(samples, duration, client)
+    logging.info(f'Load report: {json.dumps(summary)}')
+
+
+if __name__ == '__main__':
+    main()
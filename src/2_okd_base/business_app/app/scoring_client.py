@@ -0,0 +1,728 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+scoring_client is the client side of the scoring requests of the business application.
+It gathers the balancing over the model server replicas, the hedging of slow requests,
+the pooled REST client, the in-process SavedModel client, the micro-batcher,
+the prediction cache and the rate limiter.
+"""
+
+import os
+import json
+import hashlib
+import threading
+import queue
+import asyncio
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+import random
+import time
+import logging
+
+
+class Endpoint:
+    '''
+    A model server replica with its load and latency statistics
+    '''
+
+    def __init__ (self, ip: str, port: int):
+        self.ip = ip
+        self.port = port
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.latency_total = 0.0
+        self.latency_ewma = None
+
+    def get_stats (self) -> dict:
+        '''
+        Return the endpoint statistics
+        :return: stats
+        '''
+        stats = {'endpoint': f'{self.ip}:{self.port}',
+                 'requests': self.requests,
+                 'failures': self.failures,
+                 'outstanding': self.outstanding,
+                 'ejected': self.ejected_until > time.time(),
+                 'latency_mean_ms': round(self.latency_total / self.requests * 1000, 3) if self.requests else None,
+                 'latency_ewma_ms': round(self.latency_ewma * 1000, 3) if self.latency_ewma is not None else None}
+        return stats
+
+
+class EndpointBalancer:
+    '''
+    Client-side load balancing across model server replicas.
+    It picks the replica with the least outstanding requests (least_outstanding) or the least loaded
+    of two random replicas (p2c, power of two choices). A replica failing max_failures requests in a row
+    is ejected for eject_seconds, then it gets requests again: one more failure ejects it again.
+    '''
+
+    def __init__ (self, endpoints: list, policy: str = 'p2c', max_failures: int = 3, eject_seconds: float = 30,
+                  ewma_alpha: float = 0.2):
+        '''
+        :param endpoints: list of (ip, port)
+        :param policy: least_outstanding or p2c
+        :param max_failures: consecutive failures ejecting a replica
+        :param eject_seconds: seconds before an ejected replica is probed again
+        :param ewma_alpha: weight of the last request in the latency moving average
+        '''
+        if policy not in ('least_outstanding', 'p2c'):
+            raise ValueError(f'Unknown balancing policy {policy}. Use least_outstanding or p2c')
+        self.endpoints = [Endpoint(ip, port) for ip, port in endpoints]
+        self.policy = policy
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.ewma_alpha = ewma_alpha
+        self.lock = threading.Lock()
+
+    def acquire (self, exclude: Endpoint = None) -> Endpoint:
+        '''
+        Pick an endpoint for a request
+        :param exclude: an endpoint to avoid if another one is available
+        :return: endpoint
+        '''
+        with self.lock:
+            now = time.time()
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.ejected_until <= now]
+            if not candidates:
+                # All ejected: probe the first one coming back
+                candidates = [min(self.endpoints, key=lambda endpoint: endpoint.ejected_until)]
+            if exclude is not None and len(candidates) > 1:
+                candidates = [endpoint for endpoint in candidates if endpoint is not exclude]
+            if self.policy == 'p2c' and len(candidates) > 2:
+                candidates = random.sample(candidates, 2)
+            else:
+                # Shuffle to break ties at random
+                candidates = random.sample(candidates, len(candidates))
+            endpoint = min(candidates, key=lambda endpoint: (endpoint.outstanding, endpoint.latency_ewma or 0.0))
+            endpoint.outstanding += 1
+            return endpoint
+
+    def release (self, endpoint: Endpoint, latency: float, ok: bool):
+        '''
+        Record the outcome of a request
+        :param endpoint:
+        :param latency: seconds
+        :param ok: False for connection errors, timeouts and 5xx replies
+        '''
+        with self.lock:
+            endpoint.outstanding -= 1
+            endpoint.requests += 1
+            endpoint.latency_total += latency
+            if endpoint.latency_ewma is None:
+                endpoint.latency_ewma = latency
+            else:
+                endpoint.latency_ewma = self.ewma_alpha * latency + (1 - self.ewma_alpha) * endpoint.latency_ewma
+            if ok:
+                endpoint.consecutive_failures = 0
+                endpoint.ejected_until = 0.0
+                return
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= self.max_failures:
+                endpoint.ejected_until = time.time() + self.eject_seconds
+                logging.warning(f'Model server {endpoint.ip}:{endpoint.port} ejected for {self.eject_seconds} seconds '
+                                f'after {endpoint.consecutive_failures} consecutive failures')
+
+    def get_stats (self) -> list:
+        '''
+        Return the statistics of each endpoint
+        :return: stats
+        '''
+        with self.lock:
+            return [endpoint.get_stats() for endpoint in self.endpoints]
+
+
+def get_endpoints (endpoints: list) -> list:
+    '''
+    Parse the list of ip:port endpoints
+    :param endpoints:
+    :return: list of (ip, port)
+    '''
+    parsed_endpoints = []
+    for endpoint in endpoints:
+        ip, port = str(endpoint).rsplit(':', 1)
+        parsed_endpoints.append((ip, int(port)))
+    return parsed_endpoints
+
+
+class HedgingPolicy:
+    '''
+    Decide when to hedge a scoring request.
+    A duplicate is sent when the request has not answered within the given percentile of the
+    recent latencies, as long as duplicates stay within budget (a fraction of all requests).
+    '''
+
+    def __init__ (self, percentile: float = 95, budget: float = 0.05, min_samples: int = 20, window: int = 1000):
+        '''
+        :param percentile: latency percentile used as hedging delay
+        :param budget: max ratio of duplicate requests to requests
+        :param min_samples: latencies to collect before hedging
+        :param window: number of recent latencies the percentile is computed on
+        '''
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.lock = threading.Lock()
+
+    def record (self, latency: float):
+        '''
+        Record the latency of a successful attempt
+        :param latency: seconds
+        '''
+        with self.lock:
+            self.latencies.append(latency)
+
+    def get_delay (self):
+        '''
+        Count a request and return its hedging delay
+        :return: delay in seconds, None to not hedge
+        '''
+        with self.lock:
+            self.requests += 1
+            if len(self.latencies) < self.min_samples:
+                return None
+            return float(np.percentile(self.latencies, self.percentile))
+
+    def take_budget (self) -> bool:
+        '''
+        Take a duplicate request from the budget
+        :return: True if the duplicate can be sent
+        '''
+        with self.lock:
+            if self.hedges + 1 > self.budget * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def record_win (self):
+        '''
+        Record a duplicate answering first
+        '''
+        with self.lock:
+            self.hedge_wins += 1
+
+    def get_stats (self) -> dict:
+        '''
+        Return the hedging statistics
+        :return: stats
+        '''
+        with self.lock:
+            delay = np.percentile(self.latencies, self.percentile) if len(self.latencies) >= self.min_samples else None
+            stats = {'requests': self.requests,
+                     'hedges': self.hedges,
+                     'hedge_rate': round(self.hedges / self.requests, 4) if self.requests else 0.0,
+                     'hedge_wins': self.hedge_wins,
+                     'delay_ms': round(float(delay) * 1000, 3) if delay is not None else None}
+        return stats
+
+
+class ScoringClient:
+    '''
+    HTTP client for scoring requests.
+    It keeps a pool of keep-alive connections to the model server and retries
+    transient failures (connection errors, timeouts and 5xx replies) with exponential backoff.
+    With a balancer, each attempt goes to the replica it picks instead of the url host.
+    With a hedging policy, a slow POST attempt is duplicated (on another replica if balanced)
+    and the first reply wins.
+    '''
+
+    def __init__ (self, pool_size: int = 10, connect_timeout: float = 3.05, read_timeout: float = 30,
+                  max_retries: int = 3, backoff_factor: float = 0.5, status_forcelist: tuple = (500, 502, 503, 504),
+                  balancer: EndpointBalancer = None, hedging: HedgingPolicy = None):
+        '''
+        :param pool_size: max number of connections kept alive per model server
+        :param connect_timeout: seconds to wait for the connection to be established
+        :param read_timeout: seconds to wait for the model server reply
+        :param max_retries: number of retries after the first attempt
+        :param backoff_factor: sleep backoff_factor * 2 ** retry seconds between attempts
+        :param status_forcelist: HTTP status codes to retry
+        :param balancer: an EndpointBalancer across model server replicas
+        :param hedging: a HedgingPolicy for POST requests
+        '''
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.status_forcelist = set(status_forcelist)
+        self.balancer = balancer
+        self.hedging = hedging
+        # Each hedged request runs up to two attempts at the same time
+        self.hedge_executor = ThreadPoolExecutor(max_workers=2 * pool_size) if hedging else None
+        self.session = requests.Session()
+        pool_connections = max(10, len(balancer.endpoints)) if balancer else 10
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request (self, method: str, url: str, **kwargs) -> requests.Response:
+        '''
+        Send a request, retrying transient failures
+        :param method:
+        :param url:
+        :return: response
+        '''
+        retry = 0
+        while True:
+            try:
+                if self.hedging is not None and method == 'POST':
+                    response = self.send_hedged(method, url, **kwargs)
+                else:
+                    response = self.send(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+                if retry >= self.max_retries:
+                    raise
+                logging.warning(f'Scoring request failed ({error}). Retry {retry + 1} of {self.max_retries}')
+            else:
+                if response.status_code not in self.status_forcelist or retry >= self.max_retries:
+                    return response
+                logging.warning(f'Scoring request returned {response.status_code}. Retry {retry + 1} of {self.max_retries}')
+            time.sleep(self.backoff_factor * 2 ** retry)
+            retry += 1
+
+    def send (self, method: str, url: str, endpoint: Endpoint = None, record: bool = False,
+              **kwargs) -> requests.Response:
+        '''
+        Send a single attempt, to the replica picked by the balancer if any
+        :param method:
+        :param url:
+        :param endpoint: the replica acquired from the balancer. If None, a replica is acquired here
+        :param record: record the latency for the hedging delay. Only scoring attempts are recorded,
+                       so fast model status requests do not lower it
+        :return: response
+        '''
+        start = time.perf_counter()
+        if self.balancer is None:
+            response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        else:
+            endpoint = endpoint if endpoint is not None else self.balancer.acquire()
+            endpoint_url = urlsplit(url)._replace(netloc=f'{endpoint.ip}:{endpoint.port}').geturl()
+            ok = False
+            try:
+                response = self.session.request(method, endpoint_url, timeout=self.timeout, **kwargs)
+                ok = response.status_code < 500
+            finally:
+                self.balancer.release(endpoint, time.perf_counter() - start, ok)
+        if record and response.status_code < 500:
+            self.hedging.record(time.perf_counter() - start)
+        return response
+
+    def send_hedged (self, method: str, url: str, **kwargs) -> requests.Response:
+        '''
+        Send an attempt and, if it is slower than the hedging delay, a duplicate.
+        The first successful reply wins. The other attempt completes in background.
+        :param method:
+        :param url:
+        :return: response
+        '''
+        delay = self.hedging.get_delay()
+        primary = self.balancer.acquire() if self.balancer else None
+        futures = [self.hedge_executor.submit(self.send, method, url, primary, True, **kwargs)]
+        if delay is not None:
+            done, _ = wait(futures, timeout=delay)
+            if not done and self.hedging.take_budget():
+                secondary = self.balancer.acquire(exclude=primary) if self.balancer else None
+                futures.append(self.hedge_executor.submit(self.send, method, url, secondary, True, **kwargs))
+        pending = set(futures)
+        error = None
+        response = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as exception:
+                    error = exception
+                    continue
+                if response.status_code not in self.status_forcelist:
+                    if future is not futures[0]:
+                        self.hedging.record_win()
+                    return response
+        # All attempts failed: hand back the last failure to the retry loop
+        if response is not None:
+            return response
+        raise error
+
+    def post (self, url: str, data: str) -> requests.Response:
+        '''
+        Send a POST request, retrying transient failures
+        :param url:
+        :param data:
+        :return: response
+        '''
+        return self.request('POST', url, data=data)
+
+    def get (self, url: str) -> requests.Response:
+        '''
+        Send a GET request, retrying transient failures
+        :param url:
+        :return: response
+        '''
+        return self.request('GET', url)
+
+    def close (self):
+        '''
+        Close the pooled connections and stop the hedging threads
+        '''
+        if self.hedge_executor:
+            self.hedge_executor.shutdown(wait=True)
+        self.session.close()
+
+
+class SavedModelClient:
+    '''
+    In-process scoring client.
+    It loads the exported SavedModel and runs its classify signature on whole batches
+    of tf.Example, without HTTP and JSON. It requires tensorflow.
+    '''
+
+    def __init__ (self, model_path: str, signature: str = 'classification'):
+        '''
+        :param model_path: SavedModel directory, or a directory of timestamped SavedModel versions
+                           (the latest one is loaded)
+        :param signature: classify signature name
+        '''
+        # Import here so that the REST backend does not need tensorflow
+        import tensorflow as tf
+        self.tf = tf
+        self.model_path = get_saved_model_path(model_path)
+        self.model = tf.saved_model.load(self.model_path)
+        self.classify_fn = self.model.signatures[signature]
+        logging.info(f'SavedModel loaded from {self.model_path}')
+
+    def make_example (self, plain_input: dict) -> bytes:
+        '''
+        Create a serialized tf.Example from a record dictionary
+        :param plain_input:
+        :return: example
+        '''
+        tf = self.tf
+        feature = {}
+        for column, value in plain_input.items():
+            if isinstance(value, str):
+                feature[column] = tf.train.Feature(bytes_list=tf.train.BytesList(value=[value.encode('utf-8')]))
+            else:
+                # FloatList has no null: the null nan_policy gets the NaN of the nan one
+                value = float('nan') if value is None else value
+                feature[column] = tf.train.Feature(float_list=tf.train.FloatList(value=[value]))
+        example = tf.train.Example(features=tf.train.Features(feature=feature))
+        return example.SerializeToString()
+
+    def classify (self, plain_input: list) -> dict:
+        '''
+        Classify a batch of records
+        :param plain_input: a list of record dictionaries
+        :return: output, with the same shape as the TF Serving classify reply
+        '''
+        examples = [self.make_example(record) for record in plain_input]
+        prediction = self.classify_fn(inputs=self.tf.constant(examples))
+        classes = prediction['classes'].numpy()
+        scores = prediction['scores'].numpy().tolist()
+        results = [[[label.decode('utf-8'), score] for label, score in zip(labels, probabilities)]
+                   for labels, probabilities in zip(classes, scores)]
+        return {'results': results}
+
+
+def get_saved_model_path (model_path: str) -> str:
+    '''
+    Return the SavedModel directory, resolving the latest version if needed
+    :param model_path:
+    :return: saved_model_path
+    '''
+    if os.path.exists(os.path.join(model_path, 'saved_model.pb')):
+        return model_path
+    versions = [version for version in os.listdir(model_path) if version.isdigit()]
+    if not versions:
+        raise FileNotFoundError(f'No SavedModel found in {model_path}')
+    saved_model_path = os.path.join(model_path, max(versions, key=int))
+    return saved_model_path
+
+
+def create_client (model_endpoint_meta: dict):
+    '''
+    Create the scoring client based on the model endpoint configuration
+    :param model_endpoint_meta:
+    :return: client, a ScoringClient for the rest backend or a SavedModelClient for the saved_model backend
+    '''
+    if model_endpoint_meta.get('backend', 'rest') == 'saved_model':
+        client = SavedModelClient(model_endpoint_meta['model_path'],
+                                  model_endpoint_meta.get('signature', 'classification'))
+        return client
+    balancer = None
+    if model_endpoint_meta.get('endpoints'):
+        balancer = EndpointBalancer(get_endpoints(model_endpoint_meta['endpoints']),
+                                    model_endpoint_meta.get('balancing', 'p2c'),
+                                    model_endpoint_meta.get('max_failures', 3),
+                                    model_endpoint_meta.get('eject_seconds', 30))
+    hedging = None
+    if model_endpoint_meta.get('hedging'):
+        hedging = HedgingPolicy(model_endpoint_meta.get('hedge_percentile', 95),
+                                model_endpoint_meta.get('hedge_budget', 0.05),
+                                model_endpoint_meta.get('hedge_min_samples', 20))
+    client = ScoringClient(pool_size=model_endpoint_meta.get('pool_size', 10),
+                           connect_timeout=model_endpoint_meta.get('connect_timeout', 3.05),
+                           read_timeout=model_endpoint_meta.get('read_timeout', 30),
+                           max_retries=model_endpoint_meta.get('max_retries', 3),
+                           backoff_factor=model_endpoint_meta.get('backoff_factor', 0.5),
+                           balancer=balancer,
+                           hedging=hedging)
+    return client
+
+
+class MicroBatcher:
+    '''
+    Adaptive micro-batching of scoring requests.
+    Records submitted by callers are collected until max_batch_size records are waiting
+    or the first one has waited max_wait seconds. Then the batch is scored in one request and each
+    result is routed back to the future of its caller. At high traffic batches fill up at once,
+    at low traffic a record waits at most max_wait.
+    '''
+
+    def __init__ (self, send, max_batch_size: int = 64, max_wait: float = 0.005, max_in_flight: int = 1,
+                  limiter=None):
+        '''
+        :param send: a function scoring a list of records and returning one result per record
+        :param max_batch_size: max records in a batch
+        :param max_wait: max seconds the first record of a batch waits for the others
+        :param max_in_flight: max batches scored at the same time
+        :param limiter: RateLimiter of the run. If None, no rate limit
+        '''
+        self.send = send
+        self.limiter = limiter
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.batches = 0
+        self.records = 0
+        self.stop = object()
+        self.dispatcher = threading.Thread(target=self.collect, daemon=True)
+        self.dispatcher.start()
+
+    def submit (self, plain_input: dict) -> Future:
+        '''
+        Submit a record for scoring
+        :param plain_input:
+        :return: future of the result
+        '''
+        future = Future()
+        self.queue.put((plain_input, future))
+        return future
+
+    def collect (self):
+        '''
+        Collect the submitted records in batches until the batcher is closed
+        '''
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is self.stop:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self.stop:
+                    stopping = True
+                    break
+                batch.append(item)
+            self.batches += 1
+            self.records += len(batch)
+            self.executor.submit(self.dispatch, batch)
+
+    def dispatch (self, batch: list):
+        '''
+        Score a batch and set the result of each future
+        :param batch: list of record, future
+        '''
+        try:
+            if self.limiter:
+                self.limiter.sleep()
+            results = self.send([plain_input for plain_input, _ in batch])
+        # Hand any scoring failure to the callers
+        except Exception as error:
+            for _, future in batch:
+                future.set_exception(error)
+        else:
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def get_stats (self) -> dict:
+        '''
+        Return the batching statistics
+        :return: stats
+        '''
+        stats = {'batches': self.batches,
+                 'records': self.records,
+                 'mean_batch_size': round(self.records / self.batches, 2) if self.batches else 0.0}
+        return stats
+
+    def close (self):
+        '''
+        Score the pending records and stop the dispatcher
+        '''
+        self.queue.put(self.stop)
+        self.dispatcher.join()
+        self.executor.shutdown(wait=True)
+
+
+class PredictionCache:
+    '''
+    LRU cache of classify results with a time to live.
+    Keys are the hash of the record and of the served model version,
+    and the whole cache is dropped when the served model version changes.
+    '''
+
+    def __init__ (self, max_size: int = 100000, ttl: float = 3600, version_check_seconds: float = 30):
+        '''
+        :param max_size: max number of cached results
+        :param ttl: seconds a result is valid for
+        :param version_check_seconds: seconds between two checks of the served model version
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version_check_seconds = version_check_seconds
+        self.version = None
+        self.version_checked = 0.0
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def check_version (self, get_version):
+        '''
+        Refresh the served model version, dropping the cache if it changed
+        :param get_version: a function returning the served model version
+        '''
+        if time.time() - self.version_checked < self.version_check_seconds:
+            return
+        try:
+            version = get_version()
+        except (requests.exceptions.RequestException, KeyError, ValueError) as error:
+            logging.warning(f'Cannot get the served model version ({error}). Prediction cache dropped')
+            version = None
+        with self.lock:
+            self.version_checked = time.time()
+            if version != self.version or version is None:
+                if self.results:
+                    self.invalidations += 1
+                    logging.info(f'Served model version changed from {self.version} to {version}. '
+                                 f'Prediction cache dropped')
+                self.results.clear()
+                self.version = version
+
+    def get_key (self, plain_input: dict) -> str:
+        '''
+        Hash the record together with the model version
+        :param plain_input:
+        :return: key
+        '''
+        canonical = json.dumps(plain_input, sort_keys=True, separators=(',', ':'), allow_nan=True)
+        return hashlib.sha1(f'{self.version}|{canonical}'.encode('utf-8')).hexdigest()
+
+    def get (self, key: str):
+        '''
+        Return the cached result or None
+        :param key:
+        :return: result
+        '''
+        with self.lock:
+            item = self.results.get(key)
+            if item is not None and item[1] < time.time():
+                del self.results[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.results.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def count_hit (self):
+        '''
+        Count a hit served without the cache: a record repeated in the same request
+        '''
+        with self.lock:
+            self.hits += 1
+
+    def put (self, key: str, result: list):
+        '''
+        Cache a result, evicting the least recently used one if full
+        :param key:
+        :param result:
+        '''
+        with self.lock:
+            # Without a known version a result could outlive its model
+            if self.version is None:
+                return
+            self.results[key] = (result, time.time() + self.ttl)
+            self.results.move_to_end(key)
+            while len(self.results) > self.max_size:
+                self.results.popitem(last=False)
+
+    def get_stats (self) -> dict:
+        '''
+        Return the cache statistics
+        :return: stats
+        '''
+        requests_count = self.hits + self.misses
+        stats = {'version': self.version,
+                 'size': len(self.results),
+                 'hits': self.hits,
+                 'misses': self.misses,
+                 'hit_rate': round(self.hits / requests_count, 4) if requests_count else 0.0,
+                 'invalidations': self.invalidations}
+        return stats
+
+
+class RateLimiter:
+    '''
+    Space out requests to respect a maximum number of requests per second.
+    A single limiter is shared by all the senders of a run (targets, event loops and threads)
+    '''
+
+    def __init__ (self, rate: float):
+        '''
+        :param rate: max requests per second
+        '''
+        self.interval = 1.0 / rate
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def reserve (self) -> float:
+        '''
+        Take the next free slot
+        :return: seconds to wait for it
+        '''
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        return slot - now
+
+    async def wait (self):
+        '''
+        Sleep until the next free slot, in an event loop
+        '''
+        await asyncio.sleep(self.reserve())
+
+    def sleep (self):
+        '''
+        Sleep until the next free slot, in a thread
+        '''
+        time.sleep(self.reserve())
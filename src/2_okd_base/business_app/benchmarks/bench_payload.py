@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+bench_payload is a benchmark of the request payload serialization.
+It compares the former dict-loop + string replace path with the vectorized one.
+Usage (from the business_app folder):
+python ./benchmarks/bench_payload.py [datafile] [batch_size]
+"""
+
+import os
+import sys
+import json
+import timeit
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+import api_caller_model as acm
+
+
+# Former implementation ------------------------------------------------------------------------------------------------
+def legacy_set_plain_inputs (raw_inputs: pd.DataFrame) -> list:
+    '''
+    Create a list of raw records dictionary with a while loop
+    :param raw_inputs:
+    :return: plain_inputs
+    '''
+    nrows = len(raw_inputs)
+    raw_inputs_dictionary = raw_inputs.to_dict()
+    plain_inputs = []
+    i = 0
+    while i < nrows:
+        plain_input = {column: row[i] for column, row in raw_inputs_dictionary.items()}
+        plain_inputs.append(plain_input)
+        i += 1
+    return plain_inputs
+
+
+def legacy_format_plain_input (records: list) -> str:
+    '''
+    Format plain input with string replace
+    :param records:
+    :return: plain_input_formatted
+    '''
+    format_string = ','.join(str(record).replace("'", '"').replace('nan', 'NaN') for record in records)
+    return ''.join(['{"examples":[', format_string, ']}'])
+
+
+# Benchmark ------------------------------------------------------------------------------------------------------------
+def legacy_path (predictors: pd.DataFrame, batch_size: int) -> list:
+    plain_inputs = legacy_set_plain_inputs(predictors)
+    return [legacy_format_plain_input(batch) for batch in acm.set_batches(plain_inputs, batch_size)]
+
+
+def vectorized_path (predictors: pd.DataFrame, batch_size: int) -> list:
+    plain_inputs = acm.set_plain_inputs(predictors)
+    return [acm.format_plain_input(batch) for batch in acm.set_batches(plain_inputs, batch_size)]
+
+
+def dataframe_path (predictors: pd.DataFrame, batch_size: int) -> list:
+    # One payload for the whole dataframe
+    return [acm.serialize_examples(predictors)]
+
+
+def columnar_path (predictors: pd.DataFrame, batch_size: int) -> list:
+    return [acm.serialize_examples(predictors, orient='columns')]
+
+
+def main ():
+    datafile = sys.argv[1] if len(sys.argv) > 1 else './data/perf_1_q1.csv'
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    config = acm.load_yaml('./config/config.yaml')
+    data = acm.read_data(datafile)
+    _, predictors = acm.set_target_predictors(data,
+                                              config['variables_schema_meta']['target'],
+                                              config['variables_schema_meta']['inputs'])
+
+    # Same payloads, once parsed back
+    expected = [json.loads(payload) for payload in legacy_path(predictors, batch_size)]
+    actual = [json.loads(payload) for payload in vectorized_path(predictors, batch_size)]
+    assert json.dumps(expected) == json.dumps(actual), 'Payloads differ'
+
+    # String values containing "nan" are corrupted by the former path
+    strings = pd.DataFrame({'REASON': ['Financial'], 'LOAN': [float('nan')]})
+    print('legacy    :', legacy_path(strings, 1)[0])
+    print('vectorized:', vectorized_path(strings, 1)[0])
+
+    print(f'{len(predictors)} records, batch size {batch_size}')
+    paths = [('legacy', legacy_path), ('vectorized', vectorized_path),
+             ('dataframe', dataframe_path), ('columnar', columnar_path)]
+    for name, path in paths:
+        seconds = min(timeit.repeat(lambda: path(predictors, batch_size), number=1, repeat=5))
+        print(f'{name:<12}{seconds * 1000:10.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -8,18 +8,40 @@ Steps:
 1- Read the log file
 2- Split dataframe
 2- Push logs directly to a backend from within an application.
+In follow mode, the agent keeps running: it tails the log (or its rotated segments) and loads
+the new rows in micro-batches, saving a checkpoint after each of them so a restart goes on
+where it stopped.
 Author: Ivan Nardini (ivan.nardini@sas.com)
 """
 
 # Libraries
 import yaml
 import pandas as pd
+import pyarrow.parquet as pq
 import math
+import io
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import defaultdict
 import sqlalchemy
-from sqlalchemy import create_engine
+import sqlalchemy.exc
+from sqlalchemy import create_engine, text
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import os
 import logging
 
+# Column types of the performance tables, by dtype kind. TEXT for the others
+SQL_TYPES = {'b': 'BOOLEAN', 'i': 'BIGINT', 'u': 'BIGINT', 'f': 'DOUBLE PRECISION', 'M': 'TIMESTAMP'}
+# Bytes of the beginning of a csv log checked to detect a rewritten log
+LOG_FINGERPRINT_BYTES = 4096
+# Seconds a sqlite writer waits for the database lock
+SQLITE_TIMEOUT = 60
+# Width of the fixed time windows. Quarters are calendar ones
+WINDOW_WIDTHS = {'hour': pd.Timedelta(hours=1), 'day': pd.Timedelta(days=1)}
+
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p',
                     level=logging.INFO)
@@ -37,19 +59,270 @@ def load_yaml (configpath: str) -> dict:
     return conn_dict
 
 
-def read_data (datapath: str, nrows=None) -> pd.DataFrame:
+def read_data (datapath: str, nrows=None, columns=None) -> pd.DataFrame:
     '''
-    Read csv for creating a nrows Dataframe
+    Read csv, or parquet, for creating a nrows Dataframe
     :param datapath:
     :param nrows:
+    :param columns: columns to read. If None, all the columns
     :return: data
     '''
-    data = pd.read_csv(datapath, sep=',')
-    if nrows:
-        data = data[:nrows]
+    if datapath.endswith('.parquet'):
+        # Columnar format: only the projected columns are read, with their types
+        data = pd.read_parquet(datapath, columns=columns)
+        if nrows:
+            data = data[:nrows]
+    else:
+        data = pd.read_csv(datapath, sep=',', usecols=columns, nrows=nrows)
     return data
 
 
+def read_data_chunks (datapath: str, chunk_size: int, nrows=None, columns=None):
+    '''
+    Read csv, or parquet, in chunk_size Dataframes, one at a time.
+    The index of each chunk goes on with the row numbers of the file.
+    Parquet chunks do not span row groups: each row group is read, then split
+    :param datapath:
+    :param chunk_size:
+    :param nrows:
+    :param columns: columns to read. If None, all the columns
+    :return: chunks generator
+    '''
+    if datapath.endswith('.parquet'):
+        parquet_file = pq.ParquetFile(datapath)
+        start = 0
+        for row_group in range(parquet_file.num_row_groups):
+            data = parquet_file.read_row_group(row_group, columns=columns).to_pandas()
+            data.index = pd.RangeIndex(start, start + len(data))
+            for i in range(0, len(data), chunk_size):
+                chunk = data[i:i + chunk_size]
+                if nrows:
+                    chunk = chunk[:max(nrows - start - i, 0)]
+                if not len(chunk):
+                    return
+                yield chunk
+            start += len(data)
+    else:
+        yield from pd.read_csv(datapath, sep=',', usecols=columns, nrows=nrows, chunksize=chunk_size)
+
+
+def get_log_segments (logfilepath: str) -> list:
+    '''
+    Return the sorted sequence numbers of the published segments of a rotated log
+    (log_00001.csv, log_00002.csv, ... for log.csv)
+    :param logfilepath:
+    :return: segments
+    '''
+    logdir, logname = os.path.split(logfilepath)
+    name, extension = os.path.splitext(logname)
+    pattern = re.compile(rf'^{re.escape(name)}_(\d+){re.escape(extension)}$')
+    return sorted(int(match.group(1)) for match in map(pattern.match, os.listdir(logdir or '.')) if match)
+
+
+def get_segment_path (logfilepath: str, segment: int) -> str:
+    '''
+    Return the path of a log segment. Segment 0 is the log itself
+    :param logfilepath:
+    :param segment:
+    :return: segmentpath
+    '''
+    if not segment:
+        return logfilepath
+    name, extension = os.path.splitext(logfilepath)
+    return f'{name}_{segment:05d}{extension}'
+
+
+def wait_for_log (logfilepath: str, poll_seconds: float = 1):
+    '''
+    Wait for the log file of the business app, whatever its format.
+    A rotated log never shows up as a single file: its segments are loaded in follow mode only
+    :param logfilepath:
+    :param poll_seconds:
+    '''
+    logdir = os.path.dirname(logfilepath) or '.'
+    while not os.path.exists(logfilepath):
+        if os.path.isdir(logdir) and get_log_segments(logfilepath):
+            raise SystemExit(f'Found rotated segments of {logfilepath}. Set logging_meta.follow to load them')
+        logging.info(f'Waiting for log file at {logfilepath}...')
+        time.sleep(poll_seconds)
+    logging.info(f'Found log file at {logfilepath}!')
+
+
+def get_log_columns (logfilepath: str):
+    '''
+    Return the columns of the log, or of its first segment for a rotated log
+    :param logfilepath:
+    :return: columns, None if there is no log yet
+    '''
+    logdir = os.path.dirname(logfilepath) or '.'
+    segments = get_log_segments(logfilepath) if os.path.isdir(logdir) else []
+    for datapath in [get_segment_path(logfilepath, segment) for segment in segments] + [logfilepath]:
+        if not os.path.exists(datapath):
+            continue
+        if datapath.endswith('.parquet'):
+            return pq.read_schema(datapath).names
+        try:
+            return pd.read_csv(datapath, sep=',', nrows=0).columns.tolist()
+        # A csv log without header yet
+        except pd.errors.EmptyDataError:
+            return None
+    return None
+
+
+def check_upsert_key (key: list, logfilepath: str, columns: list = None):
+    '''
+    Check that the upsert key columns are loaded: they have to be in the projected columns,
+    and in the log when it is already there
+    :param key: natural key columns
+    :param logfilepath:
+    :param columns: columns to load. If None, all the columns of the log
+    '''
+    if not key:
+        raise ValueError('The upsert if_exists mode needs the key columns, e.g. [REQUEST_ID]')
+    loaded_columns = columns or get_log_columns(logfilepath)
+    if loaded_columns is None:
+        return
+    missing = [column for column in key if column not in loaded_columns]
+    if missing:
+        raise ValueError(f'Upsert key columns {missing} are not in the loaded columns of {logfilepath}')
+
+
+def read_csv_increment (datapath: str, offset: int, max_rows: int, columns=None) -> tuple:
+    '''
+    Read up to max_rows complete lines of a csv log, starting from a byte offset.
+    A last line without newline is still being written: it is left for the next read
+    :param datapath:
+    :param offset: byte offset of the first row to read
+    :param max_rows:
+    :param columns: columns to read. If None, all the columns
+    :return: data, offset of the next row
+    '''
+    lines = []
+    with open(datapath, 'rb') as file:
+        header = file.readline()
+        if not header.endswith(b'\n'):
+            return None, offset
+        file.seek(max(offset, len(header)))
+        offset = file.tell()
+        for line in file:
+            if not line.endswith(b'\n'):
+                break
+            lines.append(line)
+            offset += len(line)
+            if len(lines) == max_rows:
+                break
+    if not lines:
+        return None, offset
+    data = pd.read_csv(io.BytesIO(header + b''.join(lines)), sep=',', usecols=columns)
+    return data, offset
+
+
+def read_parquet_increment (datapath: str, offset: int, max_rows: int, columns=None) -> tuple:
+    '''
+    Read whole row groups of a parquet log, up to max_rows rows, starting from a row group
+    :param datapath:
+    :param offset: index of the first row group to read
+    :param max_rows:
+    :param columns: columns to read. If None, all the columns
+    :return: data, index of the next row group
+    '''
+    parquet_file = pq.ParquetFile(datapath)
+    tables = []
+    nrows = 0
+    while offset < parquet_file.num_row_groups and nrows < max_rows:
+        table = parquet_file.read_row_group(offset, columns=columns)
+        tables.append(table.to_pandas())
+        nrows += table.num_rows
+        offset += 1
+    if not tables:
+        return None, offset
+    data = pd.concat(tables, ignore_index=True)
+    return data, offset
+
+
+def read_increment (datapath: str, offset: int, max_rows: int, columns=None) -> tuple:
+    '''
+    Read the rows of a log from an offset: bytes for csv, row groups for parquet
+    :param datapath:
+    :param offset:
+    :param max_rows:
+    :param columns:
+    :return: data, offset of the next row
+    '''
+    if datapath.endswith('.parquet'):
+        return read_parquet_increment(datapath, offset, max_rows, columns)
+    return read_csv_increment(datapath, offset, max_rows, columns)
+
+
+def get_log_fingerprint (datapath: str, offset: int) -> str:
+    '''
+    Return the checksum of the beginning of a csv log, up to the offset already read.
+    Appending rows keeps it, rewriting the log changes it (unless with the same rows)
+    :param datapath:
+    :param offset:
+    :return: fingerprint
+    '''
+    with open(datapath, 'rb') as file:
+        head = file.read(min(offset, LOG_FINGERPRINT_BYTES))
+    return hashlib.sha256(head).hexdigest()
+
+
+def is_log_rewritten (datapath: str, checkpoint: dict, stat: os.stat_result) -> bool:
+    '''
+    Check if the log was replaced or rewritten since the checkpoint, so it has to be read from the start.
+    A csv log can only grow: a smaller file, a file of the same size written again or a different
+    beginning mean a new log, even with the same inode (to_csv truncates the file in place).
+    A parquet log is written once: any change means a new log
+    :param datapath:
+    :param checkpoint:
+    :param stat: stat of the log
+    :return: is_rewritten
+    '''
+    if stat.st_ino != checkpoint['inode']:
+        return True
+    if datapath.endswith('.parquet'):
+        return (stat.st_size, stat.st_mtime_ns) != (checkpoint.get('size'), checkpoint.get('mtime'))
+    offset = checkpoint['offset']
+    if stat.st_size < offset:
+        return True
+    if stat.st_size == offset and stat.st_mtime_ns != checkpoint.get('mtime'):
+        return True
+    # Checkpoints saved without fingerprint only rely on inode and size
+    if checkpoint.get('fingerprint') is None:
+        return False
+    return get_log_fingerprint(datapath, offset) != checkpoint['fingerprint']
+
+
+def load_checkpoint (checkpointpath: str) -> dict:
+    '''
+    Read the follow checkpoint: the log segment, the offset and row number to read from,
+    the inode, size, modification time and fingerprint of the segment to detect a replaced
+    or rewritten log, the last loaded table sequence number
+    and, while a micro-batch is being loaded, its number of rows
+    :param checkpointpath:
+    :return: checkpoint
+    '''
+    if not os.path.exists(checkpointpath):
+        return {'segment': 0, 'inode': None, 'offset': 0, 'row': 0, 'sequence': 0}
+    with open(checkpointpath) as file:
+        checkpoint = json.load(file)
+    return checkpoint
+
+
+def save_checkpoint (checkpoint: dict, checkpointpath: str):
+    '''
+    Write the follow checkpoint atomically, so a crash leaves the previous one
+    :param checkpoint:
+    :param checkpointpath:
+    '''
+    tmppath = f'{checkpointpath}.tmp'
+    with open(tmppath, 'w') as file:
+        json.dump(checkpoint, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmppath, checkpointpath)
+
+
 def split_dataframe (df: pd.DataFrame, chunk_size=1000) -> list:
     '''
     :param df:
@@ -64,7 +337,7 @@ def split_dataframe (df: pd.DataFrame, chunk_size=1000) -> list:
 
 
 def create_connection (driver: str, username: str, password: str, hostname: str, port: int,
-                       dbname: str) -> sqlalchemy.engine:
+                       dbname: str, pool_size: int = None, max_overflow: int = None) -> sqlalchemy.engine:
     '''
     Create engine based on connection string
     :param driver:
@@ -73,10 +346,20 @@ def create_connection (driver: str, username: str, password: str, hostname: str,
     :param hostname:
     :param port:
     :param dbname:
+    :param pool_size: connections kept in the pool. If None, the sqlalchemy default
+    :param max_overflow: connections opened beyond pool_size. If None, the sqlalchemy default
     :return: engine
     '''
+    if driver == 'sqlite':
+        # Embedded database for local runs: dbname is the database file. Writers wait for the file lock
+        return create_engine(f'sqlite:///{dbname}', connect_args={'timeout': SQLITE_TIMEOUT})
     conn_str = f'{driver}://{username}:{password}@{hostname}:{port}/{dbname}'
-    engine = create_engine(conn_str)
+    pool_args = {}
+    if pool_size is not None:
+        pool_args['pool_size'] = pool_size
+    if max_overflow is not None:
+        pool_args['max_overflow'] = max_overflow
+    engine = create_engine(conn_str, **pool_args)
     return engine
 
 
@@ -93,15 +376,191 @@ def set_tablename (prefix: str, sequencenumber: int, timelabel: str) -> str:
     return tablename
 
 
-def load_df_sqltable (engine: sqlalchemy.engine, df: pd.DataFrame, tablename: str):
+def get_table_ddl (df: pd.DataFrame, tablename: str, if_not_exists: bool = False) -> str:
     '''
-    Load a table in pgsql db
-    :param engine:
+    Write the create table statement of a dataframe, from its dtypes
+    :param df:
+    :param tablename:
+    :param if_not_exists: keep the table if it already exists
+    :return: ddl
+    '''
+    columns = ', '.join(f'"{column}" {SQL_TYPES.get(dtype.kind, "TEXT")}' for column, dtype in df.dtypes.items())
+    clause = 'IF NOT EXISTS ' if if_not_exists else ''
+    ddl = f'CREATE TABLE {clause}"{tablename}" ({columns})'
+    return ddl
+
+
+def copy_df_sqltable (connection, df: pd.DataFrame, tablename: str, if_exists: str = 'replace'):
+    '''
+    Load a table in pgsql db with COPY FROM STDIN.
+    The table is created from the dataframe dtypes and the rows are streamed as csv in a single
+    statement, in the transaction of the connection
+    :param connection: sqlalchemy connection
+    :param df:
+    :param tablename:
+    :param if_exists: replace or append
+    :return: None
+    '''
+    buffer = io.StringIO()
+    # Missing values are written as empty fields, which COPY reads as NULL
+    df.to_csv(buffer, sep=',', header=False, index=False)
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        if if_exists == 'replace':
+            cursor.execute(f'DROP TABLE IF EXISTS "{tablename}"')
+        cursor.execute(get_table_ddl(df, tablename, if_not_exists=if_exists != 'replace'))
+        # Name the columns: appended chunks may come in another column order than the table
+        columns = ', '.join(f'"{column}"' for column in df.columns)
+        cursor.copy_expert(f'COPY "{tablename}" ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+    finally:
+        cursor.close()
+
+
+def write_df_sqltable (connection, df: pd.DataFrame, tablename: str, method: str = 'insert',
+                       if_exists: str = 'replace'):
+    '''
+    Write a dataframe in a table, with the load method
+    :param connection: sqlalchemy connection
+    :param df:
+    :param tablename:
+    :param method: insert (pandas to_sql) or copy (postgresql only, bulk load)
+    :param if_exists: replace or append
+    :return: None
+    '''
+    if method == 'copy' and connection.dialect.name == 'postgresql':
+        copy_df_sqltable(connection, df, tablename, if_exists)
+    else:
+        df.to_sql(tablename, connection, if_exists=if_exists, index=False)
+
+
+def upsert_df_sqltable (connection, df: pd.DataFrame, tablename: str, key: list, method: str = 'insert'):
+    '''
+    Insert the rows of a dataframe in a table, replacing the rows with the same natural key.
+    The rows are staged in a work table, then the matching rows are deleted and the staged ones inserted.
+    Key columns should not be null: null keys never match
+    :param connection: sqlalchemy connection
     :param df:
     :param tablename:
+    :param key: natural key columns
+    :param method: insert (pandas to_sql) or copy (postgresql only, bulk load)
+    :return: None
+    '''
+    missing = [column for column in key if column not in df.columns]
+    if missing:
+        raise ValueError(f'Upsert key columns {missing} are not in the {tablename} chunk')
+    stagename = f'{tablename}_STAGE'
+    # The last row wins for keys repeated in the chunk
+    df = df.drop_duplicates(subset=key, keep='last')
+    write_df_sqltable(connection, df.head(0), tablename, method, if_exists='append')
+    write_df_sqltable(connection, df, stagename, method, if_exists='replace')
+    match = ' AND '.join(f'"{tablename}"."{column}" = "{stagename}"."{column}"' for column in key)
+    columns = ', '.join(f'"{column}"' for column in df.columns)
+    connection.execute(text(f'DELETE FROM "{tablename}" WHERE EXISTS (SELECT 1 FROM "{stagename}" WHERE {match})'))
+    connection.execute(text(f'INSERT INTO "{tablename}" ({columns}) SELECT {columns} FROM "{stagename}"'))
+    connection.execute(text(f'DROP TABLE "{stagename}"'))
+
+
+def get_checksum (df: pd.DataFrame) -> str:
+    '''
+    Return the checksum of the rows of a dataframe
+    :param df:
+    :return: checksum
+    '''
+    row_hashes = pd.util.hash_pandas_object(df, index=False).values
+    return hashlib.sha256(row_hashes.tobytes()).hexdigest()
+
+
+def create_journal (engine: sqlalchemy.engine, journal: str):
+    '''
+    Create the load journal table: one row for each chunk loaded in a performance table
+    :param engine:
+    :param journal:
+    :return: None
+    '''
+    with engine.begin() as connection:
+        connection.execute(text(f'CREATE TABLE IF NOT EXISTS "{journal}" ('
+                                f'tablename TEXT, source TEXT, first_row BIGINT, last_row BIGINT, '
+                                f'checksum TEXT, loaded_at TIMESTAMP)'))
+
+
+def is_journaled (connection, journal: str, entry: dict) -> bool:
+    '''
+    Check if a chunk is in the load journal
+    :param connection: sqlalchemy connection
+    :param journal:
+    :param entry: tablename, source, first_row, last_row, checksum of the chunk
+    :return: is_journaled
+    '''
+    query = text(f'SELECT COUNT(*) FROM "{journal}" WHERE tablename = :tablename AND source = :source '
+                 f'AND first_row = :first_row AND last_row = :last_row AND checksum = :checksum')
+    return connection.execute(query, entry).scalar() > 0
+
+
+def write_journal (connection, journal: str, entry: dict):
+    '''
+    Add a chunk to the load journal
+    :param connection: sqlalchemy connection
+    :param journal:
+    :param entry: tablename, source, first_row, last_row, checksum of the chunk
     :return: None
     '''
-    df.to_sql(tablename, engine, if_exists='replace', index=False)
+    query = text(f'INSERT INTO "{journal}" (tablename, source, first_row, last_row, checksum, loaded_at) '
+                 f'VALUES (:tablename, :source, :first_row, :last_row, :checksum, CURRENT_TIMESTAMP)')
+    connection.execute(query, entry)
+
+
+def get_window_sequence (timestamps: pd.Series, window: str, origin: pd.Timestamp) -> pd.Series:
+    '''
+    Return the sequence number of the time window of each timestamp.
+    The window of origin is number 1
+    :param timestamps:
+    :param window: hour, day or quarter
+    :param origin:
+    :return: sequence
+    '''
+    if window == 'quarter':
+        return (timestamps.dt.year - origin.year) * 4 + (timestamps.dt.quarter - origin.quarter) + 1
+    if window not in WINDOW_WIDTHS:
+        raise ValueError(f'Unknown window {window}. Use hour, day or quarter')
+    width = WINDOW_WIDTHS[window]
+    epoch = pd.Timestamp(0)
+    return (timestamps - epoch) // width - (origin - epoch) // width + 1
+
+
+def load_df_sqltable (engine: sqlalchemy.engine, df: pd.DataFrame, tablename: str, method: str = 'insert',
+                      if_exists: str = 'replace', key: list = None, journal: str = None, source: str = None,
+                      first_row: int = None) -> bool:
+    '''
+    Load a table in pgsql db.
+    In append and upsert mode, with a journal, chunks already in the journal are skipped and
+    the journal entry is written in the same transaction as the rows
+    :param engine:
+    :param df:
+    :param tablename:
+    :param method: insert (pandas to_sql) or copy (postgresql only, bulk load)
+    :param if_exists: replace, append or upsert (on the key columns)
+    :param key: natural key columns for upsert
+    :param journal: load journal table. If None, no journal
+    :param source: log file of the chunk, for the journal
+    :param first_row: row number of the chunk in the log file, for the journal
+    :return: loaded, False if the chunk was skipped
+    '''
+    use_journal = journal is not None and if_exists != 'replace'
+    if use_journal:
+        entry = {'tablename': tablename, 'source': source, 'first_row': first_row,
+                 'last_row': first_row + len(df), 'checksum': get_checksum(df)}
+    with engine.begin() as connection:
+        if use_journal and is_journaled(connection, journal, entry):
+            return False
+        if if_exists == 'upsert':
+            upsert_df_sqltable(connection, df, tablename, key, method)
+        else:
+            write_df_sqltable(connection, df, tablename, method, if_exists)
+        if use_journal:
+            write_journal(connection, journal, entry)
+    return True
+
 
 def delete_log (datapath: str):
     '''
@@ -116,35 +575,158 @@ def delete_log (datapath: str):
 
 def build_extract (config, nrows, chunk_size):
     LOGFILE_PATH = config['logging_meta']['logfilepath']
+    COLUMNS = config['logging_meta'].get('columns')
     NROWS = nrows
     CHUNK_SIZE = chunk_size
 
     def extract ():
-        logdf = read_data(LOGFILE_PATH, NROWS)
-        logdfs = split_dataframe(logdf, CHUNK_SIZE)
-        return logdfs
+        '''
+        Read the log in chunks, lazily: only the chunks being loaded are in memory
+        :return: logdfs generator
+        '''
+        return read_data_chunks(LOGFILE_PATH, CHUNK_SIZE, NROWS, COLUMNS)
 
     return extract
 
 
-def build_load_log_sqltables (config):
+def build_partition (config):
+    prefix = config['table_meta']['prefix']
+    timelabel = config['table_meta']['timelabel']
+    window = config['table_meta'].get('window')
+    if window:
+        origin = pd.Timestamp(config['table_meta']['window_origin'])
+        timestamp_column = config['table_meta'].get('timestamp_column', 'SCORED_AT')
+        # A window gets rows from several chunks: replacing the table would keep the last ones only
+        if config['table_meta'].get('if_exists', 'replace') == 'replace':
+            raise ValueError('Time windows need the append or upsert if_exists mode')
+
+    def partition (logdf: pd.DataFrame, sequence: int) -> list:
+        '''
+        Split a chunk in its performance tables.
+        Without window, the whole chunk goes in the table of its sequence number.
+        With a window, rows go in the table of the time window of their scoring timestamp
+        :param logdf:
+        :param sequence: sequence number of the chunk
+        :return: tables, (tablename, dataframe) list
+        '''
+        if not window:
+            return [(set_tablename(prefix, str(sequence), timelabel), logdf)]
+        # Csv logs have text timestamps
+        logdf = logdf.assign(**{timestamp_column: pd.to_datetime(logdf[timestamp_column])})
+        missing = logdf[timestamp_column].isna()
+        if missing.any():
+            logging.warning(f'{missing.sum()} rows without {timestamp_column} are not loaded')
+            logdf = logdf[~missing]
+        # Integer sequence numbers, now that there are no missing timestamps
+        windows = get_window_sequence(logdf[timestamp_column], window, origin).astype('int64')
+        if (windows < 1).any():
+            logging.warning(f'{(windows < 1).sum()} rows scored before {origin} are not loaded')
+        return [(set_tablename(prefix, str(window_sequence), timelabel), window_df)
+                for window_sequence, window_df in logdf.groupby(windows) if window_sequence >= 1]
+
+    return partition
+
+
+def build_connect (config):
     driver = config['db_endpoint_meta']['driver']
     username = config['db_endpoint_meta']['username']
     password = config['db_endpoint_meta']['password']
     hostname = config['db_endpoint_meta']['hostname']
     port = config['db_endpoint_meta']['port']
     dbname = config['db_endpoint_meta']['dbname']
-    prefix = config['table_meta']['prefix']
-    timelabel = config['table_meta']['timelabel']
+    if_exists = config['table_meta'].get('if_exists', 'replace')
+    journal = config['table_meta'].get('journal')
 
-    def load_log_sqltables (logdfs):
-        engine = create_connection(driver, username, password, hostname, port, dbname)
-        try:
+    def connect (pool_size: int = None, max_overflow: int = None) -> sqlalchemy.engine:
+        '''
+        Create the engine of the performance db, with the load journal in append and upsert mode
+        :param pool_size:
+        :param max_overflow:
+        :return: engine
+        '''
+        engine = create_connection(driver, username, password, hostname, port, dbname,
+                                   pool_size=pool_size, max_overflow=max_overflow)
+        if journal and if_exists != 'replace':
+            create_journal(engine, journal)
+        return engine
+
+    return connect
+
+
+def build_load_table (config):
+    method = config['table_meta'].get('load_method', 'insert')
+    if_exists = config['table_meta'].get('if_exists', 'replace')
+    key = config['table_meta'].get('key')
+    journal = config['table_meta'].get('journal')
+    # Upsert matches the loaded rows on the key columns
+    if if_exists == 'upsert':
+        check_upsert_key(key, config['logging_meta']['logfilepath'], config['logging_meta'].get('columns'))
+
+    def load_table (engine: sqlalchemy.engine, df: pd.DataFrame, tablename: str, source: str = None,
+                    first_row: int = 0) -> bool:
+        '''
+        Load a chunk in its performance table, with the load method and if_exists mode of the config
+        :param engine:
+        :param df:
+        :param tablename:
+        :param source: log file of the chunk, for the journal
+        :param first_row: row number of the chunk in the log file, for the journal
+        :return: loaded, False if the chunk was already loaded
+        '''
+        return load_df_sqltable(engine, df, tablename, method, if_exists, key, journal, source, first_row)
+
+    return load_table
+
+
+def build_load_log_sqltables (config):
+    workers = config['db_endpoint_meta'].get('workers', 1)
+    source = os.path.basename(config['logging_meta']['logfilepath'])
+    connect = build_connect(config)
+    load_chunk = build_load_table(config)
+    partition = build_partition(config)
+
+    def load_log_sqltables (logdfs) -> dict:
+        '''
+        Load the chunks in their performance tables, workers tables at a time.
+        Each worker holds a connection of the pool.
+        Chunks are taken from logdfs as workers get free, so at most 2 * workers chunks are in memory.
+        Loads of the same table (the time window of several chunks) wait for each other
+        :param logdfs: chunks iterable
+        :return: failures, the error by table name
+        '''
+        engine = connect(pool_size=workers, max_overflow=0)
+        failures = {}
+        table_locks = defaultdict(threading.Lock)
+
+        def load_table (logdf, tblname, first_row):
+            with table_locks[tblname]:
+                return load_chunk(engine, logdf, tblname, source, first_row)
+
+        def collect (done):
+            for future in done:
+                tblname = futures.pop(future)
+                try:
+                    if not future.result():
+                        logging.info(f'{tblname} chunk already loaded. Skipped')
+                # Errors of the db (sqlalchemy), of the driver (copy path), wrapped by pandas,
+                # or of the chunk (upsert key columns missing)
+                except (sqlalchemy.exc.SQLAlchemyError, engine.dialect.dbapi.Error, pd.io.sql.DatabaseError,
+                        ValueError) as error:
+                    logging.error(f'Failed to load {tblname}: {error}')
+                    failures[tblname] = str(error)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
             for i, logdf in enumerate(logdfs, 1):
-                tblname = set_tablename(prefix, str(i), timelabel)
-                load_df_sqltable(engine, logdf, tblname)
-        except RuntimeError as error:
-            logging.error(error)
+                for tblname, tabledf in partition(logdf, i):
+                    first_row = int(tabledf.index[0]) if len(tabledf) else 0
+                    futures[executor.submit(load_table, tabledf, tblname, first_row)] = tblname
+                if len(futures) >= 2 * workers:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    collect(done)
+            collect(list(futures))
+        engine.dispose()
+        return failures
 
     return load_log_sqltables
 
@@ -162,15 +744,123 @@ def build_remove_log(config):
     return delete_log
 
 
+def build_follow (config):
+    LOGFILE_PATH = config['logging_meta']['logfilepath']
+    COLUMNS = config['logging_meta'].get('columns')
+    CHECKPOINT_PATH = config['logging_meta'].get('checkpointpath', f'{LOGFILE_PATH}.checkpoint.json')
+    BATCH_ROWS = config['logging_meta'].get('follow_batch_rows', 1000)
+    POLL_SECONDS = config['logging_meta'].get('follow_poll_seconds', 1)
+    IDLE_SECONDS = config['logging_meta'].get('follow_idle_seconds')
+    partition = build_partition(config)
+    connect = build_connect(config)
+    load_table = build_load_table(config)
+
+    def read_next (checkpoint: dict, max_rows: int) -> tuple:
+        '''
+        Read the next micro-batch after the checkpoint, moving on to the next segment
+        when the current one is consumed
+        :param checkpoint:
+        :param max_rows:
+        :return: logdf (None if there are no new rows), checkpoint
+        '''
+        checkpoint = {name: value for name, value in checkpoint.items() if name != 'pending_rows'}
+        segments = get_log_segments(LOGFILE_PATH)
+        if not segments:
+            segments = [0] if os.path.exists(LOGFILE_PATH) else []
+        while True:
+            if checkpoint['segment'] not in segments:
+                following = [segment for segment in segments if segment > checkpoint['segment']]
+                if not following:
+                    return None, checkpoint
+                checkpoint.update(segment=following[0], inode=None, offset=0, row=0)
+            segmentpath = get_segment_path(LOGFILE_PATH, checkpoint['segment'])
+            try:
+                stat = os.stat(segmentpath)
+            except FileNotFoundError:
+                return None, checkpoint
+            # The business app replaced or rewrote the log with a new one: read it from the start
+            if is_log_rewritten(segmentpath, checkpoint, stat):
+                checkpoint.update(inode=stat.st_ino, offset=0, row=0)
+            logdf, offset = read_increment(segmentpath, checkpoint['offset'], max_rows, COLUMNS)
+            fingerprint = None if segmentpath.endswith('.parquet') else get_log_fingerprint(segmentpath, offset)
+            checkpoint.update(offset=offset, size=stat.st_size, mtime=stat.st_mtime_ns, fingerprint=fingerprint)
+            if logdf is not None:
+                checkpoint['row'] = checkpoint.get('row', 0) + len(logdf)
+                return logdf, checkpoint
+            # Published segments are complete: go on with the next one, if any
+            following = [segment for segment in segments if segment > checkpoint['segment']]
+            if not following:
+                return None, checkpoint
+            checkpoint.update(segment=following[0], inode=None, offset=0, row=0)
+
+    def remove_consumed (checkpoint: dict):
+        '''
+        Delete the segments before the checkpoint one. The checkpoint segment is kept,
+        so the business app goes on with the segment numbering
+        :param checkpoint:
+        '''
+        for segment in get_log_segments(LOGFILE_PATH):
+            if 0 < segment < checkpoint['segment']:
+                os.remove(get_segment_path(LOGFILE_PATH, segment))
+
+    def follow ():
+        '''
+        Tail the log and load each micro-batch of new rows in the next performance table.
+        The size of the micro-batch is saved in the checkpoint before the load, and the position
+        after it: after a crash the same rows are read again and loaded in the same table, which
+        is replaced (or skipped thanks to the journal in append and upsert mode),
+        so no row is lost or duplicated
+        '''
+        engine = connect()
+        checkpoint = load_checkpoint(CHECKPOINT_PATH)
+        logging.info(f'Following {LOGFILE_PATH} from segment {checkpoint["segment"]}, offset {checkpoint["offset"]}...')
+        idle_start = time.time()
+        while True:
+            logdf, next_checkpoint = read_next(checkpoint, checkpoint.get('pending_rows') or BATCH_ROWS)
+            if logdf is None:
+                if next_checkpoint != checkpoint:
+                    save_checkpoint(next_checkpoint, CHECKPOINT_PATH)
+                    checkpoint = next_checkpoint
+                if IDLE_SECONDS and time.time() - idle_start >= IDLE_SECONDS:
+                    logging.info(f'No new rows for {IDLE_SECONDS} seconds. Stop following')
+                    return
+                time.sleep(POLL_SECONDS)
+                continue
+            sequence = checkpoint['sequence'] + 1
+            save_checkpoint(dict(checkpoint, pending_rows=len(logdf)), CHECKPOINT_PATH)
+            source = os.path.basename(get_segment_path(LOGFILE_PATH, next_checkpoint['segment']))
+            logdf.index = pd.RangeIndex(next_checkpoint['row'] - len(logdf), next_checkpoint['row'])
+            for tblname, tabledf in partition(logdf, sequence):
+                loaded = load_table(engine, tabledf, tblname, source, int(tabledf.index[0]))
+                logging.info(f'Loaded {len(tabledf)} rows in {tblname}' if loaded else f'{tblname} chunk already loaded. Skipped')
+            next_checkpoint['sequence'] = sequence
+            save_checkpoint(next_checkpoint, CHECKPOINT_PATH)
+            checkpoint = next_checkpoint
+            remove_consumed(checkpoint)
+            idle_start = time.time()
+
+    return follow
+
+
 def main ():
     # Read configuration ----------------------------------------
     logging.info('Loading configuration file...')
     CONFIGPATH = './config/config.yaml'
     CONFIG = load_yaml(CONFIGPATH)
 
+    # Follow the log -------------------------------------------
+    # The log (or its segments) is polled: no need to wait for it
+    if CONFIG['logging_meta'].get('follow', False):
+        follow = build_follow(CONFIG)
+        follow()
+        return
+
+    # Wait for the log ------------------------------------------
+    wait_for_log(CONFIG['logging_meta']['logfilepath'])
+
     # Build methods ----------------------------------------------
     logging.info('Building methods...')
-    extract = build_extract(CONFIG, None, chunk_size=1000)
+    extract = build_extract(CONFIG, None, chunk_size=CONFIG['logging_meta'].get('chunk_size', 1000))
     load = build_load_log_sqltables(CONFIG)
     remove = build_remove_log(CONFIG)
 
@@ -178,7 +868,11 @@ def main ():
     logging.info('Reading log file for cluster file system...')
     logdfs = extract()
     logging.info('Loading performance logs in the backend postgres db...')
-    load(logdfs)
+    failures = load(logdfs)
+    if failures:
+        # Keep the log file, so the next run loads it again
+        logging.error(f'{len(failures)} performance tables failed: {", ".join(failures)}')
+        raise SystemExit(1)
     logging.info('Performance logs loaded successfully!')
     remove() # It's just for the demo. We should define a logrotate on k8s
     logging.info('Log file removed!')
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+bench_load is a benchmark of the performance table load.
+It compares the pandas to_sql path (row-wise INSERT) with the COPY FROM STDIN one,
+against the postgres db of the config file.
+Usage (from the logging_agent folder):
+python ./benchmarks/bench_load.py [logfile] [chunk_size]
+"""
+
+import os
+import sys
+import time
+import pandas as pd
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+import load_logs as ll
+
+
+def time_load (engine, logdfs: list, prefix: str, method: str) -> float:
+    '''
+    Load the chunks in the benchmark tables and return the elapsed seconds
+    :param engine:
+    :param logdfs:
+    :param prefix:
+    :param method:
+    :return: seconds
+    '''
+    start = time.perf_counter()
+    for i, logdf in enumerate(logdfs, 1):
+        ll.load_df_sqltable(engine, logdf, ll.set_tablename(prefix, str(i), 'B'), method)
+    return time.perf_counter() - start
+
+
+def drop_tables (engine, prefix: str, ntables: int):
+    with engine.begin() as connection:
+        for i in range(1, ntables + 1):
+            connection.execute(text(f'DROP TABLE IF EXISTS "{ll.set_tablename(prefix, str(i), "B")}"'))
+
+
+def main ():
+    logfile = sys.argv[1] if len(sys.argv) > 1 else './logs/log.csv'
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    config = ll.load_yaml('./config/config.yaml')
+    db_endpoint_meta = config['db_endpoint_meta']
+    engine = ll.create_connection(db_endpoint_meta['driver'], db_endpoint_meta['username'],
+                                  db_endpoint_meta['password'], db_endpoint_meta['hostname'],
+                                  db_endpoint_meta['port'], db_endpoint_meta['dbname'])
+    logdf = ll.read_data(logfile)
+    logdfs = ll.split_dataframe(logdf, chunk_size)
+    prefix = 'BENCHPERF'
+
+    print(f'{len(logdf)} rows, {len(logdfs)} tables of {chunk_size} rows')
+    results = {}
+    for method in ('insert', 'copy'):
+        results[method] = time_load(engine, logdfs, prefix, method)
+        # Same rows back, whatever the load method
+        loaded = pd.concat([pd.read_sql_table(ll.set_tablename(prefix, str(i), 'B'), engine)
+                            for i in range(1, len(logdfs) + 1)])
+        assert len(loaded) == len(logdf), f'{method}: {len(loaded)} rows loaded out of {len(logdf)}'
+        print(f'{method:<8}{results[method]:10.3f} s {len(logdf) / results[method]:12.0f} rows/s')
+    print(f'speedup {results["insert"] / results["copy"]:.1f}x')
+    drop_tables(engine, prefix, len(logdfs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+bench_pipeline is a local benchmark of the performance data loop:
+scoring log -> logging agent load -> retrain etl extract and transform.
+It runs both steps with their own config files against an embedded sqlite database,
+so no postgres is needed.
+Usage (from the logging_agent folder):
+python ./benchmarks/bench_pipeline.py [logfile] [chunk_size] [workers]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+RETRAIN_PATH = os.path.join(BENCHMARKS_PATH, '..', '..', '..', '1_workflow_base', 'retrain')
+sys.path.insert(0, os.path.join(BENCHMARKS_PATH, '..', 'app'))
+sys.path.insert(0, RETRAIN_PATH)
+import load_logs as ll
+import etl
+
+
+def set_sqlite_backend (config: dict, dbpath: str) -> dict:
+    '''
+    Point the db endpoint of a config to the sqlite database
+    :param config:
+    :param dbpath:
+    :return: config
+    '''
+    config['db_endpoint_meta'].update({'driver': 'sqlite', 'dbname': dbpath})
+    return config
+
+
+def main ():
+    logfile = sys.argv[1] if len(sys.argv) > 1 else './logs/log.csv'
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    workpath = tempfile.mkdtemp()
+    dbpath = os.path.join(workpath, 'perf.db')
+
+    # Same backend and table prefix for the agent and the etl
+    etl_config = set_sqlite_backend(etl.load_yaml(os.path.join(RETRAIN_PATH, 'config.yaml')), dbpath)
+    agent_config = set_sqlite_backend(ll.load_yaml('./config/config.yaml'), dbpath)
+    agent_config['logging_meta'].update({'logfilepath': logfile, 'columns': None})
+    agent_config['table_meta'].update({'prefix': etl_config['table_meta']['prefix'], 'if_exists': 'replace',
+                                       'window': None})
+    agent_config['db_endpoint_meta']['workers'] = workers
+
+    try:
+        timings = {}
+        start = time.perf_counter()
+        failures = ll.build_load_log_sqltables(agent_config)(ll.build_extract(agent_config, None, chunk_size)())
+        timings['agent load'] = time.perf_counter() - start
+        assert not failures, f'Failed tables: {failures}'
+
+        # The etl extract streams the chunks the transform consumes: they are timed together
+        start = time.perf_counter()
+        train_df = etl.build_transform(etl_config)(etl.build_extract(etl_config)())
+        timings['etl extract+transform'] = time.perf_counter() - start
+
+        engine = etl.create_connection('sqlite', None, None, None, None, dbpath)
+        prefix = etl_config['table_meta']['prefix']
+        ntables = len(etl.get_table_metas_list(engine, etl.write_get_table_names_query(prefix, 'sqlite')))
+        engine.dispose()
+        nrows = len(ll.read_data(logfile))
+        assert len(train_df) == nrows, f'{len(train_df)} training rows out of {nrows} logged'
+        print(f'{nrows} rows, {ntables} tables of {chunk_size} rows, {workers} workers')
+        for step, seconds in timings.items():
+            print(f'{step:<24}{seconds:10.3f} s {nrows / seconds:12.0f} rows/s')
+        print(f'{"total":<24}{sum(timings.values()):10.3f} s')
+    finally:
+        shutil.rmtree(workpath)
+
+
+if __name__ == '__main__':
+    main()